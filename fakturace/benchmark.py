@@ -0,0 +1,371 @@
+"""
+Benchmarks for the storage layer and commands.
+
+Run as ``python -m fakturace.benchmark --sizes 100,1000,10000``, each size
+generates a synthetic storage with given number of invoices.
+"""
+
+from __future__ import annotations
+
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from contextlib import chdir, contextmanager, redirect_stdout
+from io import StringIO
+from itertools import cycle
+from tempfile import TemporaryDirectory
+
+from .cli import main as cli_main
+from .rates import DecimalRates
+from .storage import InvoiceStorage, ProformaStorage, QuoteStorage, WebStorage
+
+STORAGES = {
+    "invoice": InvoiceStorage,
+    "web": WebStorage,
+    "quote": QuoteStorage,
+    "proforma": ProformaStorage,
+}
+
+CATEGORIES = ("hosting", "support", "development")
+
+TEMPLATES = {
+    "invoice.tex": (
+        "\\VAR{invoiceid} \\VAR{name|escape_tex} \\VAR{address|escape_tex}\n"
+        "\\VAR{item|escape_tex} \\VAR{date} \\VAR{due}\n"
+        "\\VAR{rows}\n"
+        "\\VAR{total} \\VAR{total_vat} \\VAR{total_sum} \\VAR{currency}\n"
+    ),
+    "row.tex": (
+        "\\VAR{item|escape_tex} & \\VAR{quantity} & \\VAR{rate} & "
+        "\\VAR{total} \\VAR{currency}\\\\\n"
+    ),
+}
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+TEMPLATES["quote.tex"] = TEMPLATES["invoice.tex"]
+TEMPLATES["proforma.tex"] = TEMPLATES["invoice.tex"]
+
+
+def write_file(filename, content):
+    directory = os.path.dirname(filename)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    with open(filename, "w") as handle:
+        handle.write(content)
+
+
+def generate(  # noqa: PLR0913
+    basedir,
+    invoices=1000,
+    contacts=50,
+    years=(2024, 2025),
+    series=("invoice", "web"),
+    paid_ratio=0.8,
+):
+    """
+    Generate synthetic storage in basedir.
+
+    Creates contacts, banks, templates, exchange rate cache for the years
+    (in the rates directory, see use_rates) and invoices spread evenly across
+    the years, months and series. Returns list of invoice filenames.
+    """
+    write_file(
+        os.path.join(basedir, "config", "config.ini"),
+        "[config]\ncategories = {}\n".format(",".join(CATEGORIES)),
+    )
+    for name, content in TEMPLATES.items():
+        write_file(os.path.join(basedir, "template", name), content)
+
+    storage = InvoiceStorage(basedir)
+    for currency in ("CZK", "EUR"):
+        storage.update_bank(currency, bank=f"Bank {currency}", account="1234/5678")
+        write_file(
+            os.path.join(basedir, "banks", f"{currency}-proforma.ini"),
+            "[bank]\nnote = Proforma\n",
+        )
+    for number in range(contacts):
+        storage.update_contact(
+            f"contact{number}",
+            f"Customer {number} s.r.o.",
+            f"Street {number}",
+            f"City {number % 10}",
+            ("CZ", "DE", "US")[number % 3],
+            f"billing{number}@example.com",
+            f"{10000000 + number}",
+            f"CZ{10000000 + number}" if number % 3 == 0 else "",
+            ("EUR", "CZK")[number % 2],
+            CATEGORIES[number % len(CATEGORIES)],
+        )
+
+    # Exchange rates for every day in a single year cache file
+    for year in years:
+        day = datetime.date(year, 1, 1)
+        rates = {}
+        while day.year == year:
+            rates[day.isoformat()] = {"EUR": "25.000", "USD": "22.000"}
+            day += datetime.timedelta(days=1)
+        write_file(
+            os.path.join(basedir, "rates", f"rates-year-{year}"), json.dumps(rates)
+        )
+
+    # Invoices
+    sequences = {}
+    periods = cycle(
+        (STORAGES[name](basedir), year, month)
+        for name in series
+        for year in years
+        for month in range(1, 13)
+    )
+    result = []
+    for number in range(invoices):
+        storage, year, month = next(periods)
+        params = {"year": f"{year % 100:02d}", "month": f"{month:02d}"}
+        params["full_year"] = year
+        # Numbering period as used by write_invoices
+        key = (storage.series, storage.template.format(order="*", **params))
+        sequences[key] = order = sequences.get(key, 0) + 1
+        filename = storage.path(
+            storage.data,
+            storage.template.format(order=storage.order.format(order), **params),
+        )
+        date = datetime.date(year, month, 1 + number % 28)
+        lines = [
+            "[invoice]",
+            f"contact = contact{number % contacts}",
+            f"date = {date.isoformat()}",
+            f"due = {(date + datetime.timedelta(days=15)).isoformat()}",
+            f"item = Service {number}: monthly fee",
+            f"rate = {100 + number % 900}",
+        ]
+        if number % 4 == 0:
+            lines.extend(
+                (f"item_2 = Extra work #{number}", "rate_2 = 50", "quantity_2 = 3")
+            )
+        write_file(filename, "\n".join(lines) + "\n")
+        if number % 10 < paid_ratio * 10:
+            write_file(filename.replace(".ini", ".paid"), "paid\n")
+        result.append(filename)
+    return result
+
+
+@contextmanager
+def use_rates(basedir):
+    """Use exchange rates generated in the basedir and restore them afterwards."""
+    saved = (
+        DecimalRates.cache_dir,
+        dict(DecimalRates.datacache),
+        set(DecimalRates.years),
+    )
+    DecimalRates.cache_dir = os.path.join(basedir, "rates")
+    DecimalRates.datacache.clear()
+    DecimalRates.years.clear()
+    try:
+        yield
+    finally:
+        DecimalRates.cache_dir = saved[0]
+        DecimalRates.datacache.clear()
+        DecimalRates.datacache.update(saved[1])
+        DecimalRates.years.clear()
+        DecimalRates.years.update(saved[2])
+
+
+def run_cli(*args):
+    with redirect_stdout(StringIO()):
+        cli_main(list(args))
+
+
+def run_python(*args, runs=1):
+    """Run Python in a fresh interpreter, to measure startup time."""
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        path for path in (PACKAGE_DIR, env.get("PYTHONPATH")) if path
+    )
+    for _run in range(runs):
+        subprocess.run(
+            [sys.executable, *args], check=True, env=env, stdout=subprocess.DEVNULL
+        )
+
+
+def measure(function):
+    """
+    Return run time and peak traced memory of a function.
+
+    The function is called twice, tracing memory allocations slows it down,
+    so the time is measured in a run without tracing.
+    """
+    start = time.perf_counter()
+    function()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        _current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def clear_index(storage):
+    with storage.index.connection:
+        storage.index.connection.execute("DELETE FROM invoices")
+
+
+def get_operations(basedir, years, count, contacts, startup=20):
+    """Return list of (name, items, callable) operations to benchmark."""
+    storage = InvoiceStorage(basedir)
+    # Rates are not available in subprocesses, use an invoice in CZK there
+    local = next(
+        invoice.invoiceid
+        for invoice in storage.list(lazy=True)
+        if invoice.currency == "CZK"
+    )
+    total = len(storage.glob())
+    sample = [
+        os.path.splitext(os.path.basename(name))[0] for name in storage.glob()[:count]
+    ]
+    operations = [
+        ("storage.list", total, lambda: sum(1 for _invoice in storage.list())),
+        (
+            "index (cold)",
+            total,
+            lambda: [clear_index(storage), sum(1 for _row in storage.index.refresh())],
+        ),
+        ("index (warm)", total, lambda: sum(1 for _row in storage.index.refresh())),
+        (
+            "summary",
+            total,
+            lambda: run_cli(
+                "summary", "--from", f"{years[0]}-01", "--to", f"{years[-1]}-12"
+            ),
+        ),
+    ]
+    operations.extend(
+        (
+            command,
+            total,
+            lambda command=command: [
+                run_cli(command, "--year", str(year)) for year in years
+            ],
+        )
+        for command in ("list", "notpaid", "xmlexport", "contacts")
+    )
+    operations.extend(
+        (
+            (
+                "startup (python)",
+                startup,
+                lambda: run_python("-c", "pass", runs=startup),
+            ),
+            (
+                "startup (detail)",
+                startup,
+                lambda: run_python(
+                    "-m", "fakturace.cli", "detail", local, runs=startup
+                ),
+            ),
+            (
+                "create",
+                count,
+                lambda: [
+                    storage.create(f"contact{i % contacts}") for i in range(count)
+                ],
+            ),
+            (
+                "write_tex",
+                len(sample),
+                lambda: [storage.get(name).write_tex(force=True) for name in sample],
+            ),
+        )
+    )
+    return operations
+
+
+def run(sizes, contacts=50, years=(2024, 2025), count=100, startup=20):
+    """Run benchmarks for all sizes, returns list of result dicts."""
+    results = []
+    for size in sizes:
+        with TemporaryDirectory() as basedir:
+            generate(basedir, invoices=size, contacts=contacts, years=years)
+            with use_rates(basedir), chdir(basedir):
+                for name, items, operation in get_operations(
+                    basedir, years, min(count, size), contacts, startup
+                ):
+                    elapsed, peak = measure(operation)
+                    results.append(
+                        {
+                            "size": size,
+                            "operation": name,
+                            "items": items,
+                            "seconds": elapsed,
+                            "throughput": items / elapsed if elapsed else 0,
+                            "peak_memory": peak,
+                        }
+                    )
+    return results
+
+
+def format_table(results):
+    header = "{:>8} {:<16} {:>8} {:>10} {:>12} {:>12}".format(
+        "Size", "Operation", "Items", "Time [s]", "Items/s", "Memory [MiB]"
+    )
+    lines = [header, "-" * len(header)]
+    lines.extend(
+        "{size:>8} {operation:<16} {items:>8} {seconds:>10.3f} "
+        "{throughput:>12.0f} {memory:>12.1f}".format(
+            memory=result["peak_memory"] / 1024 / 1024, **result
+        )
+        for result in results
+    )
+    return "\n".join(lines)
+
+
+def main(args=None):
+    parser = ArgumentParser(description="Fakturace benchmarks.")
+    parser.add_argument(
+        "--sizes",
+        default="100,1000",
+        help="Comma separated numbers of invoices to generate",
+    )
+    parser.add_argument(
+        "--contacts", type=int, default=50, help="Number of contacts to generate"
+    )
+    parser.add_argument(
+        "--years",
+        default="2024,2025",
+        help="Comma separated years to spread the invoices across",
+    )
+    parser.add_argument(
+        "--count",
+        type=int,
+        default=100,
+        help="Number of invoices to create and render",
+    )
+    parser.add_argument(
+        "--startup",
+        type=int,
+        default=20,
+        help="Number of command invocations to measure startup time",
+    )
+    parser.add_argument("--json", action="store_true", help="Output JSON")
+    params = parser.parse_args(args)
+
+    results = run(
+        [int(size) for size in params.sizes.split(",")],
+        contacts=params.contacts,
+        years=[int(year) for year in params.years.split(",")],
+        count=params.count,
+        startup=params.startup,
+    )
+    if params.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print(format_table(results))
+
+
+if __name__ == "__main__":
+    main()
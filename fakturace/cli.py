@@ -1,41 +1,112 @@
+import csv
 import datetime
+import json
+import os
 import subprocess
-from argparse import ArgumentParser
+import sys
+from argparse import ArgumentParser, ArgumentTypeError
+from contextlib import redirect_stderr, redirect_stdout, suppress
 from fnmatch import fnmatch
-from xml.etree import ElementTree
+from io import StringIO
+from itertools import islice
 
-from vies.types import VATIN
-
-from .storage import InvoiceStorage, ProformaStorage, QuoteStorage, WebStorage
+from . import server, timing
+from .index import invoice_matches, match_words, tokenize
+from .query import SERIES, Query, create_storages, parse_series, parse_years
+from .rates import DecimalRates
+from .storage import InvoiceStorage
+from .vat import normalize
 
 COMMANDS = {}
 
+SOCKET = os.path.join(InvoiceStorage.config, "fakturace.sock")
+
+
+def parse_month(value):
+    """Parse YYYY-MM month specification."""
+    try:
+        date = datetime.datetime.strptime(value, "%Y-%m")  # noqa: DTZ007
+    except ValueError as error:
+        raise ArgumentTypeError(f"Invalid month: {value}") from error
+    return date.year, date.month
+
+
+def parse_years_argument(value):
+    try:
+        return parse_years(value)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error)) from error
+
+
+def parse_series_argument(value):
+    try:
+        return parse_series(value)
+    except ValueError as error:
+        raise ArgumentTypeError(str(error)) from error
+
+
+def add_years_arguments(parser):
+    parser.add_argument(
+        "--year",
+        type=int,
+        help="Year to process",
+        default=datetime.date.today().year,
+    )
+    parser.add_argument(
+        "--years",
+        type=parse_years_argument,
+        help="Years to process (2019-2026 or 2019,2021), overrides --year",
+    )
+
 
 def register_command(command):
     """Register a command in command line interface."""
-    COMMANDS[command.__name__.lower()] = command
+    COMMANDS[command.get_name()] = command
     return command
 
 
 class Command:
     """Basic command object."""
 
-    def __init__(self, args):
-        """Construct Command object."""
+    # Command line name, defaults to lower case class name
+    name = None
+
+    # Whether the command can operate on several series at once
+    multiple_series = False
+
+    def __init__(self, args, storages=None):
+        """
+        Construct Command object.
+
+        The storages map storage classes to resident instances, see Serve.
+        """
         self.args = args
-        if args.quotes:
-            self.storage = QuoteStorage()
+        if args.series:
+            names = args.series
+        elif args.quotes:
+            names = ["quote"]
         elif args.web:
-            self.storage = WebStorage()
+            names = ["web"]
         elif args.proforma:
-            self.storage = ProformaStorage()
+            names = ["proforma"]
         else:
-            self.storage = InvoiceStorage()
+            names = ["invoice"]
+        if len(names) > 1 and not self.multiple_series:
+            raise ValueError(f"Command {args.cmd} operates on a single series!")
+        if storages is None:
+            self.storages = create_storages(names)
+        else:
+            self.storages = [storages[SERIES[name]] for name in names]
+        self.storage = self.storages[0]
+
+    @classmethod
+    def get_name(cls):
+        return cls.name or cls.__name__.lower()
 
     @classmethod
     def add_parser(cls, subparser):
         """Create parser for command line."""
-        return subparser.add_parser(cls.__name__.lower(), description=cls.__doc__)
+        return subparser.add_parser(cls.get_name(), description=cls.__doc__)
 
     def run(self):
         """Execute the command."""
@@ -45,16 +116,13 @@ class Command:
 class FilterCommand(Command):
     """List invoices."""
 
+    multiple_series = True
+
     @classmethod
     def add_parser(cls, subparser):
         """Create parser for command line."""
         parser = super().add_parser(subparser)
-        parser.add_argument(
-            "--year",
-            type=int,
-            help="Year to process",
-            default=datetime.date.today().year,
-        )
+        add_years_arguments(parser)
         parser.add_argument(
             "--filter",
             help="Filter by ID",
@@ -65,24 +133,31 @@ class FilterCommand(Command):
             help="Include VAT",
             default=False,
         )
-        parser.add_argument("match", nargs="?", help="Match string to find")
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            help="Number of processes loading changed invoices",
+        )
+        parser.add_argument(
+            "match",
+            nargs="?",
+            help="Words to find in items, remarks or contact, prefixes match too",
+        )
         return parser
 
     def match(self, invoice):
-        if self.args.filter and not fnmatch(invoice.invoiceid, self.args.filter):
-            return False
+        return not self.args.filter or fnmatch(invoice.invoiceid, self.args.filter)
 
-        if not self.args.match:
-            return True
-        match = self.args.match.lower()
-        return (
-            match in invoice.invoice["item"].lower()
-            or match in invoice.invoice["contact"].lower()
-            or match in invoice.contact["name"].lower()
-        )
+    def get_query(self):
+        return Query(self.storages, self.args.years or [self.args.year])
+
+    def get_invoices(self):
+        """Return invoices to filter, header fields are loaded from the index."""
+        return self.get_query().invoices(jobs=self.args.jobs, match=self.args.match)
 
     def list(self):
-        for invoice in self.storage.list(self.args.year):
+        for invoice in self.get_invoices():
             if self.match(invoice):
                 yield invoice
 
@@ -111,11 +186,101 @@ class List(FilterCommand):
         print(f"Total: {total:.2f} CZK")
 
 
+def get_watermark_path(storage):
+    """Return path of the file with stamps of invoices exported to XML."""
+    return storage.path(storage.config, f"xmlexport-{storage.series}.json")
+
+
 @register_command
 class XMLExport(FilterCommand):
     """XML exportinvoices."""
 
+    # Number of invoices to resolve exchange rates for at once
+    chunk_size = 100
+
+    def __init__(self, args, storages=None):
+        super().__init__(args, storages)
+        self.stamps = {}
+        self.exported = []
+
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument("--output", "-o", help="Output file, defaults to stdout")
+        parser.add_argument(
+            "--since-last",
+            action="store_true",
+            help="Export only invoices new or changed since last such export",
+            default=False,
+        )
+        return parser
+
+    @property
+    def watermark_path(self):
+        return get_watermark_path(self.storage)
+
+    @staticmethod
+    def load_watermark(storage):
+        """Return file stamps of previously exported invoices."""
+        filename = get_watermark_path(storage)
+        if not os.path.exists(filename):
+            return {}
+        with open(filename) as handle:
+            return json.load(handle)
+
+    def save_watermark(self):
+        for storage in self.storages:
+            watermark = self.load_watermark(storage)
+            for owner, filename in self.exported:
+                if owner is storage:
+                    key = os.path.relpath(filename, storage.basedir)
+                    watermark[key] = self.stamps[filename]
+            with open(get_watermark_path(storage), "w") as handle:
+                json.dump(watermark, handle, indent=2, sort_keys=True)
+
+    def get_invoices(self):
+        """Return invoices from files, the export needs invoice rows."""
+        if not self.args.since_last:
+            # Rows and totals are computed only for matching invoices
+            return self.get_query().list(
+                lazy=not self.args.jobs, jobs=self.args.jobs, match=self.args.match
+            )
+        return self.list_changed()
+
+    def list_changed(self):
+        """Return invoices changed since the last export."""
+        query = self.get_query()
+        for storage in self.storages:
+            watermark = self.load_watermark(storage)
+            filenames = []
+            for filename in query.filenames(storage):
+                key = os.path.relpath(filename, storage.basedir)
+                stamp = list(storage.file_stamp(filename))
+                if watermark.get(key) == stamp:
+                    continue
+                self.stamps[filename] = stamp
+                filenames.append(filename)
+            paid = [None] * len(filenames)
+            for invoice in storage.load(
+                filenames, paid, lazy=not self.args.jobs, jobs=self.args.jobs
+            ):
+                if not self.args.match or invoice_matches(invoice, self.args.match):
+                    yield invoice
+
+    def list(self):
+        # Exchange rates are resolved for chunks of invoices based on their
+        # headers, the invoices are streamed as they are loaded
+        invoices = super().list()
+        while chunk := list(islice(invoices, self.chunk_size)):
+            self.storage.prefetch_rates(chunk)
+            for invoice in chunk:
+                yield invoice
+                self.exported.append((invoice.storage, invoice.name))
+
     def add_element(self, root, name: str, text: str | None = None):
+        from xml.etree import ElementTree  # noqa: PLC0415
+
         added = ElementTree.SubElement(root, name)
         if text is not None:
             added.text = text
@@ -147,127 +312,172 @@ class XMLExport(FilterCommand):
             self.add_element(sazba, "DPH", invoice.invoice[f"{prefix}total_vat"])
         self.add_element(root, "Celkem", invoice.invoice[f"{prefix}total_sum"])
 
-    def run(self):  # noqa: PLR0915
+    def build_invoice(self, invoice):  # noqa: PLR0915
+        """Build FaktVyd element for an invoice."""
+        from xml.etree import ElementTree  # noqa: PLC0415
+
+        output = ElementTree.Element("FaktVyd")
+        self.add_element(output, "Doklad", invoice.invoiceid)
+        self.add_element(output, "CisRada", "0")
+        self.add_element(output, "Popis", invoice.invoice["item"])
+        self.add_element(output, "Vystaveno", invoice.invoice["date"])
+        self.add_element(output, "DatUcPr", invoice.invoice["date"])
+        self.add_element(output, "PlnenoDPH", invoice.invoice["date"])
+        self.add_element(output, "Splatno", invoice.invoice["due"])
+        self.add_element(output, "DatSkPoh", invoice.invoice["date"])
+        self.add_element(output, "KodDPH", "19Ř21")
+        self.add_element(output, "ZjednD", "0")
+        self.add_element(output, "VarSymbol", invoice.invoiceid)
+
+        # Druh (N: normální, L: zálohová, F: proforma, D: doklad k přijaté platbě)
+        self.add_element(output, "Druh", "N")
+        self.add_element(
+            output,
+            "Dobropis",
+            "0" if float(invoice.invoice["total_sum"]) > 0 else "1",
+        )
+        self.add_element(output, "ZpVypDPH", "1")
+        self.add_element(output, "SazbaDPH1", "12")
+        self.add_element(output, "SazbaDPH2", "21")
+        self.add_element(output, "Proplatit", invoice.invoice["czk_total_sum"])
+        self.add_element(output, "Vyuctovano", "0")
+        self.add_amounts(output, invoice, "czk_")
+        if invoice.currency != "CZK":
+            valuty = self.add_element(output, "Valuty")
+            mena = self.add_element(valuty, "Mena")
+            self.add_element(mena, "Kod", "EUR")
+            self.add_element(mena, "Mnozstvi", "1")
+            self.add_element(mena, "Kurs", invoice.invoice["czk_rate"])
+            self.add_amounts(valuty, invoice)
+
+        self.add_element(output, "PriUhrZbyv", "0")
+        if invoice.currency != "CZK":
+            self.add_element(output, "ValutyProp", invoice.invoice["total_sum"])
+        self.add_element(output, "SumZaloha", "0")
+        self.add_element(output, "SumZalohaC", "0")
+
+        prijemce = self.add_element(output, "DodOdb")
+        self.add_element(prijemce, "ObchNazev", invoice.contact["name"])
+        adresa = self.add_element(prijemce, "ObchAdresa")
+        self.add_element(adresa, "Ulice", invoice.contact["address"])
+        self.add_element(adresa, "Misto", invoice.contact["city"])
+        self.add_element(adresa, "Stat", invoice.contact["country"])
+        self.add_element(prijemce, "FaktNazev", invoice.contact["name"])
+        if invoice.contact["tax_reg"] and invoice.contact["vat_reg"].startswith("CZ"):
+            self.add_element(prijemce, "ICO", invoice.contact["tax_reg"])
+        if invoice.contact["vat_reg"]:
+            self.add_element(prijemce, "DIC", invoice.contact["vat_reg"])
+        adresa = self.add_element(prijemce, "FaktAdresa")
+        self.add_element(adresa, "Ulice", invoice.contact["address"])
+        self.add_element(adresa, "Misto", invoice.contact["city"])
+        self.add_element(adresa, "Stat", invoice.contact["country"])
+        if invoice.contact["vat_reg"]:
+            self.add_element(prijemce, "PlatceDPH", "1")
+            self.add_element(prijemce, "FyzOsoba", "0")
+
+        seznam = self.add_element(output, "SeznamPolozek")
+        for row in invoice.invoice["rows_data"]:
+            polozka = self.add_element(seznam, "Polozka")
+            self.add_element(polozka, "Popis", row["item"])
+            self.add_element(polozka, "PocetMJ", row["quantity"])
+            if invoice.currency == "CZK":
+                self.add_element(polozka, "Cena", row["total"])
+            else:
+                self.add_element(polozka, "Valuty", row["total"])
+        return output
+
+    def run(self):
         """Execute the command."""
-        document = ElementTree.Element("MoneyData")
-        invoices = ElementTree.SubElement(document, "SeznamFaktVyd")
+        if self.args.output:
+            with open(self.args.output, "w", encoding="utf-8") as handle:
+                self.write(handle)
+        else:
+            self.write(sys.stdout)
+        if self.args.since_last:
+            self.save_watermark()
 
-        for invoice in self.list():
-            output = ElementTree.SubElement(invoices, "FaktVyd")
-            self.add_element(output, "Doklad", invoice.invoiceid)
-            self.add_element(output, "CisRada", "0")
-            self.add_element(output, "Popis", invoice.invoice["item"])
-            self.add_element(output, "Vystaveno", invoice.invoice["date"])
-            self.add_element(output, "DatUcPr", invoice.invoice["date"])
-            self.add_element(output, "PlnenoDPH", invoice.invoice["date"])
-            self.add_element(output, "Splatno", invoice.invoice["due"])
-            self.add_element(output, "DatSkPoh", invoice.invoice["date"])
-            self.add_element(output, "KodDPH", "19Ř21")
-            self.add_element(output, "ZjednD", "0")
-            self.add_element(output, "VarSymbol", invoice.invoiceid)
-
-            # Druh (N: normální, L: zálohová, F: proforma, D: doklad k přijaté platbě)
-            self.add_element(output, "Druh", "N")
-            self.add_element(
-                output,
-                "Dobropis",
-                "0" if float(invoice.invoice["total_sum"]) > 0 else "1",
-            )
-            self.add_element(output, "ZpVypDPH", "1")
-            self.add_element(output, "SazbaDPH1", "12")
-            self.add_element(output, "SazbaDPH2", "21")
-            self.add_element(output, "Proplatit", invoice.invoice["czk_total_sum"])
-            self.add_element(output, "Vyuctovano", "0")
-            self.add_amounts(output, invoice, "czk_")
-            if invoice.currency != "CZK":
-                valuty = self.add_element(output, "Valuty")
-                mena = self.add_element(valuty, "Mena")
-                self.add_element(mena, "Kod", "EUR")
-                self.add_element(mena, "Mnozstvi", "1")
-                self.add_element(mena, "Kurs", invoice.invoice["czk_rate"])
-                self.add_amounts(valuty, invoice)
-
-            self.add_element(output, "PriUhrZbyv", "0")
-            if invoice.currency != "CZK":
-                self.add_element(output, "ValutyProp", invoice.invoice["total_sum"])
-            self.add_element(output, "SumZaloha", "0")
-            self.add_element(output, "SumZalohaC", "0")
-
-            prijemce = self.add_element(output, "DodOdb")
-            self.add_element(prijemce, "ObchNazev", invoice.contact["name"])
-            adresa = self.add_element(prijemce, "ObchAdresa")
-            self.add_element(adresa, "Ulice", invoice.contact["address"])
-            self.add_element(adresa, "Misto", invoice.contact["city"])
-            self.add_element(adresa, "Stat", invoice.contact["country"])
-            self.add_element(prijemce, "FaktNazev", invoice.contact["name"])
-            if invoice.contact["tax_reg"] and invoice.contact["vat_reg"].startswith(
-                "CZ"
-            ):
-                self.add_element(prijemce, "ICO", invoice.contact["tax_reg"])
-            if invoice.contact["vat_reg"]:
-                self.add_element(prijemce, "DIC", invoice.contact["vat_reg"])
-            adresa = self.add_element(prijemce, "FaktAdresa")
-            self.add_element(adresa, "Ulice", invoice.contact["address"])
-            self.add_element(adresa, "Misto", invoice.contact["city"])
-            self.add_element(adresa, "Stat", invoice.contact["country"])
-            if invoice.contact["vat_reg"]:
-                self.add_element(prijemce, "PlatceDPH", "1")
-                self.add_element(prijemce, "FyzOsoba", "0")
-
-            seznam = self.add_element(output, "SeznamPolozek")
-            for row in invoice.invoice["rows_data"]:
-                polozka = self.add_element(seznam, "Polozka")
-                self.add_element(polozka, "Popis", row["item"])
-                self.add_element(polozka, "PocetMJ", row["quantity"])
-                if invoice.currency == "CZK":
-                    self.add_element(polozka, "Cena", row["total"])
-                else:
-                    self.add_element(polozka, "Valuty", row["total"])
+    def write(self, handle):
+        """
+        Write the export, each invoice is written as soon as it is built.
 
-        ElementTree.indent(document)
-        ElementTree.dump(document)
+        The output is identical to indenting and dumping the whole document.
+        """
+        from xml.etree import ElementTree  # noqa: PLC0415
+
+        handle.write("<MoneyData>\n  <SeznamFaktVyd")
+        empty = True
+        for invoice in self.list():
+            element = self.build_invoice(invoice)
+            ElementTree.indent(element, level=2)
+            if empty:
+                handle.write(">")
+                empty = False
+            handle.write("\n    ")
+            handle.write(ElementTree.tostring(element, encoding="unicode"))
+            handle.flush()
+        if empty:
+            handle.write(" />\n</MoneyData>\n")
+        else:
+            handle.write("\n  </SeznamFaktVyd>\n</MoneyData>\n")
 
 
 @register_command
 class Contacts(Command):
     """List invoices."""
 
+    multiple_series = True
+
     @classmethod
     def add_parser(cls, subparser):
         """Create parser for command line."""
         parser = super().add_parser(subparser)
+        add_years_arguments(parser)
         parser.add_argument(
-            "--year",
+            "--country",
+            help="Country to list",
+        )
+        parser.add_argument(
+            "--all",
+            action="store_true",
+            help="List all contacts, not only the ones with invoices",
+            default=False,
+        )
+        parser.add_argument(
+            "--jobs",
+            "-j",
             type=int,
-            help="Year to process",
-            default=datetime.date.today().year,
+            help="Number of processes loading changed invoices",
         )
         parser.add_argument(
-            "--country",
-            help="Country to list",
+            "match",
+            nargs="?",
+            help="Words to find in items, remarks or contact, prefixes match too",
         )
-        parser.add_argument("match", nargs="?", help="Match string to find")
         return parser
 
-    def match(self, invoice):
-        if self.args.country and self.args.country != invoice.contact["country"]:
+    def match(self, key, contact):
+        if self.args.country and self.args.country != contact["country"]:
             return False
-        if not self.args.match:
+        # Invoices are matched by the query
+        if not self.args.all or not self.args.match:
             return True
-        match = self.args.match.lower()
-        return (
-            match in invoice.invoice["item"].lower()
-            or match in invoice.invoice["contact"].lower()
-            or match in invoice.contact["name"].lower()
-        )
+        words = tokenize(key) + tokenize(contact["name"])
+        return match_words(words, tokenize(self.args.match))
+
+    def get_keys(self):
+        """Return keys of contacts to list, only the contact files are read."""
+        if self.args.all:
+            return self.storage.list_contacts()
+        query = Query(self.storages, self.args.years or [self.args.year])
+        return query.contacts(jobs=self.args.jobs, match=self.args.match)
 
     def run(self):
         """Execute the command."""
         contacts = {}
-        for invoice in self.storage.list(self.args.year):
-            if not self.match(invoice):
-                continue
-            contacts[invoice.contact["name"]] = invoice.contact
+        for key in self.get_keys():
+            contact = self.storage.read_contact(key)
+            if self.match(key, contact):
+                contacts[contact["name"]] = contact
 
         for contact in contacts.values():
             print(f"{contact['name']}, {contact['city']}, {contact.get('email')}")
@@ -319,35 +529,106 @@ class Detail(Command):
 class WriteTex(Detail):
     """Generate tex."""
 
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Render even if the tex is up to date",
+            default=False,
+        )
+        return parser
+
     def run(self):
         """Execute the command."""
         invoice = self.storage.get(self.args.id)
-        invoice.write_tex()
+        if not invoice.write_tex(force=self.args.force):
+            print(f"{invoice.invoiceid} is up to date")
 
 
 @register_command
-class BuildPDF(Detail):
+class BuildPDF(Command):
     """Build PDF."""
 
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--year",
+            type=int,
+            help="Year to process in batch mode",
+            default=datetime.date.today().year,
+        )
+        parser.add_argument("--month", type=int, help="Month to process in batch mode")
+        parser.add_argument("--filter", help="Filter by ID in batch mode")
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            help="Number of parallel builds, defaults to number of CPUs",
+        )
+        parser.add_argument(
+            "--force",
+            action="store_true",
+            help="Rebuild even if the PDF is up to date",
+            default=False,
+        )
+        parser.add_argument(
+            "id", nargs="?", help="Invoice id, builds all matching invoices if omitted"
+        )
+        return parser
+
     def run(self):
         """Execute the command."""
-        invoice = self.storage.get(self.args.id)
-        invoice.build_pdf()
+        if self.args.id:
+            invoice = self.storage.get(self.args.id)
+            if not invoice.build_pdf(force=self.args.force):
+                print(f"{invoice.invoiceid} is up to date")
+            return 0
+
+        invoiceids = [
+            os.path.splitext(os.path.basename(filename))[0]
+            for filename in self.storage.glob(self.args.year, self.args.month)
+        ]
+        if self.args.filter:
+            invoiceids = [
+                invoiceid
+                for invoiceid in invoiceids
+                if fnmatch(invoiceid, self.args.filter)
+            ]
+        built = failed = 0
+        for invoiceid, changed, error in self.storage.build_pdfs(
+            invoiceids, self.args.jobs, force=self.args.force
+        ):
+            if error is not None:
+                print(f"{invoiceid}: FAILED: {error}")
+                failed += 1
+            elif changed:
+                print(f"{invoiceid}: OK")
+                built += 1
+            else:
+                print(f"{invoiceid}: up to date")
+        print()
+        print(
+            f"Built {built} PDFs, {len(invoiceids) - built - failed} up to date, "
+            f"{failed} failed"
+        )
+        return 1 if failed else 0
 
 
 @register_command
 class Summary(Command):
     """Show invoice summary."""
 
+    multiple_series = True
+
     @classmethod
     def add_parser(cls, subparser):
         parser = super().add_parser(subparser)
-        parser.add_argument(
-            "--year",
-            type=int,
-            help="Year to process",
-            default=datetime.date.today().year,
-        )
+        add_years_arguments(parser)
         parser.add_argument(
             "--vat",
             action="store_true",
@@ -355,12 +636,69 @@ class Summary(Command):
             default=False,
         )
         parser.add_argument("--summary", "-s", action="store_true", help="show YTD sum")
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            help="Number of processes loading changed invoices",
+        )
+        parser.add_argument(
+            "--from",
+            dest="start",
+            type=parse_month,
+            help="First month to process (YYYY-MM), defaults to start of the year",
+        )
+        parser.add_argument(
+            "--to",
+            dest="end",
+            type=parse_month,
+            help="Last month to process (YYYY-MM), defaults to end of the year",
+        )
         return parser
 
+    def get_months(self):
+        """Return list of (year, month) tuples to summarize."""
+        if self.args.years and not self.args.start and not self.args.end:
+            return [(year, month) for year in self.args.years for month in range(1, 13)]
+        end = self.args.end or (self.args.year, 12)
+        start = self.args.start or (end[0], 1)
+        result = []
+        for index in range(start[0] * 12 + start[1] - 1, end[0] * 12 + end[1]):
+            year, month = divmod(index, 12)
+            result.append((year, month + 1))
+        return result
+
     def run(self):
         categories = self.storage.settings["categories"].split(",")
+        months = self.get_months()
+        totals = dict.fromkeys(months, 0)
+        monthcats = {month: dict.fromkeys(categories, 0) for month in months}
+
+        # Scan invoices once and bucket them by month
+        years = {year for year, _month in months}
+        for storage in self.storages:
+            # The filename period is used when it includes month, same as when
+            # listing, otherwise the date which can be in the adjacent year
+            monthly = "{month}" in storage.template
+            if monthly:
+                query = Query([storage], years)
+            else:
+                query = Query(
+                    [storage], {year + delta for year in years for delta in (-1, 0, 1)}
+                )
+            for invoice in query.invoices(jobs=self.args.jobs):
+                if monthly:
+                    key = storage.parse_filename(os.path.basename(invoice.name))
+                else:
+                    date = invoice.invoice["date"]
+                    key = (int(date[:4]), int(date[5:7]))
+                if key not in totals:
+                    continue
+                amount = invoice.amount_czk_vat if self.args.vat else invoice.amount_czk
+                monthcats[key][invoice.category] += amount
+                totals[key] += amount
+
         supertotal = 0
-        year = self.args.year
         supercats = dict.fromkeys(categories, 0)
         cat_format = " ".join(f"{{{x}:7.0f}} CZK" for x in categories)
         header = "Month         Total {}".format(
@@ -368,15 +706,12 @@ class Summary(Command):
         )
         print(header)
         print("-" * len(header))
-        for month in range(1, 13):
-            total = 0
-            cats = dict.fromkeys(categories, 0)
-            for invoice in self.storage.list(year, month):
-                amount = invoice.amount_czk_vat if self.args.vat else invoice.amount_czk
-                cats[invoice.category] += amount
-                supercats[invoice.category] += amount
-                total += amount
-                supertotal += amount
+        for year, month in months:
+            total = totals[year, month]
+            cats = monthcats[year, month]
+            supertotal += total
+            for category, amount in cats.items():
+                supercats[category] += amount
             if self.args.summary:
                 display_total = supertotal
                 cat_sums = cat_format.format(**supercats)
@@ -388,6 +723,109 @@ class Summary(Command):
         print(f"Summary {supertotal:7.0f} CZK {cat_format.format(**supercats)}")
 
 
+@register_command
+class Import(Command):
+    """Create invoices from CSV or JSON."""
+
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--format",
+            choices=("csv", "json"),
+            help="Input format, detected from file extension by default",
+        )
+        parser.add_argument(
+            "filename",
+            nargs="?",
+            default="-",
+            help="File with invoices, reads standard input by default",
+        )
+        return parser
+
+    def get_format(self):
+        if self.args.format:
+            return self.args.format
+        if self.args.filename.endswith(".csv"):
+            return "csv"
+        return "json"
+
+    def parse(self, handle):
+        """Parse invoice specifications, each has contact and invoice fields."""
+        if self.get_format() == "csv":
+            # Empty cells do not override contact defaults
+            return [
+                {key: value for key, value in row.items() if value}
+                for row in csv.DictReader(handle)
+            ]
+        content = handle.read()
+        if content.lstrip().startswith("["):
+            return json.loads(content)
+        # JSON lines
+        return [json.loads(line) for line in content.splitlines() if line.strip()]
+
+    def run(self):
+        """Execute the command."""
+        if self.args.filename == "-":
+            rows = self.parse(sys.stdin)
+        else:
+            with open(self.args.filename, newline="") as handle:
+                rows = self.parse(handle)
+        specs = []
+        for number, row in enumerate(rows, start=1):
+            if not row.get("contact"):
+                raise ValueError(f"Missing contact for invoice {number}")
+            # Null values do not override contact defaults, same as empty cells
+            specs.append(
+                {key: str(value) for key, value in row.items() if value is not None}
+            )
+        # Report created invoices even when failing
+        created = []
+        try:
+            self.storage.create_many(specs, created)
+        finally:
+            for filename in created:
+                print(os.path.splitext(os.path.basename(filename))[0])
+
+
+@register_command
+class Rates(Command):
+    """Show or prefetch exchange rates."""
+
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--prefetch",
+            action="store_true",
+            help="Download rates for the whole year",
+            default=False,
+        )
+        parser.add_argument(
+            "--year",
+            type=int,
+            help="Year to prefetch",
+            default=datetime.date.today().year,
+        )
+        parser.add_argument(
+            "--date",
+            help="Date to show (YYYY-MM-DD)",
+            default=datetime.date.today().isoformat(),
+        )
+        return parser
+
+    def run(self):
+        """Execute the command."""
+        if self.args.prefetch:
+            count = DecimalRates.prefetch(self.args.year)
+            print(f"Stored rates for {count} days of {self.args.year}")
+            return
+        for currency, rate in sorted(DecimalRates.download(self.args.date).items()):
+            print(f"{currency}: {rate}")
+
+
 @register_command
 class Add(Command):
     """Create new invoice."""
@@ -411,11 +849,12 @@ class Add(Command):
         contact = self.storage.read_contact(self.args.contact)
         vat_reg = contact.get("vat_reg", "")
         if vat_reg:
-            vat_reg = vat_reg.strip().replace(" ", "")
-            vatin = VATIN(vat_reg[:2], vat_reg[2:])
+            vat_reg = normalize(vat_reg)
             if self.args.skip_validation:
-                vatin.verify()
-            elif not vatin.data.valid:
+                from vies.types import VATIN  # noqa: PLC0415
+
+                VATIN(vat_reg[:2], vat_reg[2:]).verify()
+            elif not self.storage.vat_cache.validate(vat_reg):
                 raise ValueError(f"Invalid VAT: {vat_reg}")
 
         filename = self.storage.create(self.args.contact)
@@ -424,8 +863,140 @@ class Add(Command):
             subprocess.run(["gvim", filename], check=True)
 
 
-def main(args=None):
-    """CLI entry point."""
+@register_command
+class ValidateContacts(Command):
+    """Validate VAT numbers of all contacts."""
+
+    name = "validate-contacts"
+
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--jobs",
+            "-j",
+            type=int,
+            default=4,
+            help="Number of concurrent validations",
+        )
+        parser.add_argument(
+            "--cached",
+            action="store_true",
+            help="Use fresh cached results instead of checking again",
+            default=False,
+        )
+        return parser
+
+    def run(self):
+        contacts = {}
+        for key in self.storage.list_contacts():
+            vat_reg = self.storage.read_contact(key).get("vat_reg", "").strip()
+            if vat_reg:
+                contacts[key] = normalize(vat_reg)
+        results = self.storage.vat_cache.validate_many(
+            contacts.values(), jobs=self.args.jobs, refresh=not self.args.cached
+        )
+        failed = 0
+        for key, vat_reg in contacts.items():
+            valid = results[vat_reg]
+            if valid is True:
+                status = "valid"
+            elif valid is False:
+                status = "invalid"
+            else:
+                status = f"error: {valid}"
+            if valid is not True:
+                failed += 1
+            print(f"{key}: {vat_reg}: {status}")
+        return 1 if failed else 0
+
+
+@register_command
+class Migrate(Command):
+    """Move invoices to per year directories or back to flat data directory."""
+
+    @classmethod
+    def add_parser(cls, subparser):
+        """Create parser for command line."""
+        parser = super().add_parser(subparser)
+        parser.add_argument(
+            "--flat",
+            action="store_true",
+            help="Move invoices back to the flat layout",
+        )
+        return parser
+
+    def run(self):
+        """Execute the command."""
+        moves = self.storage.migrate(partitioned=not self.args.flat)
+        # Keep the export watermark valid, the file stamps are preserved
+        filename = get_watermark_path(self.storage)
+        if moves and os.path.exists(filename):
+            with open(filename) as handle:
+                watermark = json.load(handle)
+            for old, new in moves:
+                key = os.path.relpath(old, self.storage.basedir)
+                if key in watermark:
+                    watermark[os.path.relpath(new, self.storage.basedir)] = (
+                        watermark.pop(key)
+                    )
+            with open(filename, "w") as handle:
+                json.dump(watermark, handle, indent=2, sort_keys=True)
+        print(f"Moved {len(moves)} invoices")
+
+
+@register_command
+class Serve(Command):
+    """Serve commands over a Unix socket keeping the caches warm."""
+
+    def run(self):
+        """Execute the command."""
+        storages = {type(storage): storage for storage in create_storages(list(SERIES))}
+        with server.Server(SOCKET, lambda args: execute(args, storages)) as daemon:
+            print(f"Listening on {SOCKET}")
+            sys.stdout.flush()
+            with suppress(KeyboardInterrupt):
+                daemon.serve_forever()
+
+
+def execute(args, storages):
+    """Execute command with resident storages and capture its output."""
+    stdout = StringIO()
+    stderr = StringIO()
+    with redirect_stdout(stdout), redirect_stderr(stderr):
+        try:
+            status = main(args, storages)
+        except SystemExit as error:
+            # Raised by the argument parser
+            status = error.code if isinstance(error.code, int) else 1
+        except Exception as error:  # noqa: BLE001
+            print(f"{error.__class__.__name__}: {error}", file=sys.stderr)
+            status = 1
+    return {
+        "status": status or 0,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+    }
+
+
+def forward(params):
+    """Whether the command can be executed by the server."""
+    if params.local or params.cmd == "serve":
+        return False
+    # These need the terminal or stdin of the client
+    if params.cmd == "add" and params.edit:
+        return False
+    return not (params.cmd == "import" and params.filename == "-")
+
+
+def main(args=None, storages=None):
+    """
+    CLI entry point.
+
+    Commands are forwarded to the server if it is running in the current
+    directory, storages are passed by the server.
+    """
     parser = ArgumentParser(
         description="Fakturace.",
         epilog="This utility is developed at <{}>.".format(
@@ -443,16 +1014,68 @@ def main(args=None):
         action="store_true",
         help="Operate on proforma invoices",
     )
+    parser.add_argument(
+        "--series",
+        type=parse_series_argument,
+        help="Comma separated series to operate on ({})".format(", ".join(SERIES)),
+    )
+    parser.add_argument(
+        "--timings",
+        action="store_const",
+        const="table",
+        help="Report calls, time and cache hit rates of storage phases to stderr",
+    )
+    parser.add_argument(
+        "--timings-json",
+        action="store_const",
+        const="json",
+        dest="timings",
+        help="Report the timings as JSON",
+    )
+    parser.add_argument("--profile", metavar="FILE", help="Dump cProfile stats to FILE")
+    parser.add_argument(
+        "--local",
+        action="store_true",
+        help="Do not forward the command to a running server",
+    )
 
     subparser = parser.add_subparsers(dest="cmd")
     for command in COMMANDS.values():
         command.add_parser(subparser)
 
+    if args is None:
+        args = sys.argv[1:]
     params = parser.parse_args(args)
 
-    command = COMMANDS[params.cmd](params)
-    command.run()
+    if storages is None and forward(params):
+        response = server.request(SOCKET, args)
+        if response is not None:
+            sys.stdout.write(response["stdout"])
+            sys.stderr.write(response["stderr"])
+            return response["status"]
+
+    if params.timings:
+        timing.enable()
+    profiler = None
+    if params.profile:
+        import cProfile  # noqa: PLC0415
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+    try:
+        command = COMMANDS[params.cmd](params, storages)
+        return command.run()
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(params.profile)
+        if params.timings:
+            timing.disable()
+            if params.timings == "json":
+                print(timing.format_json(), file=sys.stderr)
+            else:
+                print(timing.format_table(), file=sys.stderr)
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
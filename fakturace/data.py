@@ -16,4 +16,8 @@ RATE_URL = (
     "http://www.cnb.cz/cs/financni_trhy/devizovy_trh/"
     "kurzy_devizoveho_trhu/denni_kurz.txt?date={2}.{1}.{0}"
 )
+RATE_YEAR_URL = (
+    "http://www.cnb.cz/cs/financni_trhy/devizovy_trh/"
+    "kurzy_devizoveho_trhu/rok.txt?rok={0}"
+)
 CACHE_DIR = os.path.expanduser("~/.cache/fakturace")
@@ -0,0 +1,434 @@
+from __future__ import annotations
+
+import json
+import os
+import re
+import sqlite3
+from functools import cached_property
+
+from .data import CONTACT
+from .timing import cache, timed
+
+SCHEMA_VERSION = 6
+
+# Invoice fields stored in the index
+FIELDS = (
+    "contact",
+    "date",
+    "due",
+    "item",
+    "currency",
+    "category",
+    "total",
+    "total_vat",
+    "total_sum",
+    "czk_rate",
+    "czk_total",
+    "czk_total_vat",
+    "czk_total_sum",
+)
+
+WORD_RE = re.compile(r"\w+")
+
+# Highest code point, appended to a term to get upper bound for its prefix
+PREFIX_END = "\U0010ffff"
+
+SCHEMA = """
+DROP TABLE IF EXISTS invoices;
+CREATE TABLE invoices (
+    filename TEXT PRIMARY KEY,
+    series TEXT NOT NULL,
+    mtime INTEGER NOT NULL,
+    size INTEGER NOT NULL,
+    paid INTEGER NOT NULL,
+    invoiceid TEXT NOT NULL,
+    depends TEXT NOT NULL,
+    {fields}
+);
+CREATE INDEX invoices_series ON invoices (series);
+CREATE INDEX invoices_contact ON invoices (series, contact);
+DROP TABLE IF EXISTS terms;
+CREATE TABLE terms (
+    term TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    PRIMARY KEY (term, filename)
+) WITHOUT ROWID;
+CREATE INDEX terms_filename ON terms (filename);
+DROP TABLE IF EXISTS builds;
+CREATE TABLE builds (
+    filename TEXT PRIMARY KEY,
+    inputs TEXT,
+    tex TEXT,
+    pdf TEXT
+);
+DROP TABLE IF EXISTS sequences;
+CREATE TABLE sequences (
+    series TEXT NOT NULL,
+    period TEXT NOT NULL,
+    last INTEGER NOT NULL,
+    PRIMARY KEY (series, period)
+);
+PRAGMA user_version = {version};
+""".format(
+    fields=",\n    ".join(f"{field} TEXT NOT NULL" for field in FIELDS),
+    version=SCHEMA_VERSION,
+)
+
+
+def tokenize(text):
+    """Return lower case words of a text."""
+    return [word.lower() for word in WORD_RE.findall(text)]
+
+
+def invoice_terms(invoice):
+    """
+    Return words of an invoice to index.
+
+    These are words of the items, remarks and of the contact key, the contact
+    name is matched separately as it is not stored in the invoice file.
+    """
+    terms = set(tokenize(invoice.invoice["contact"]))
+    for key, value in invoice.invoice.header_items():
+        if key == "item" or key.startswith(("item_", "remark_")):
+            terms.update(tokenize(value))
+    return terms
+
+
+def match_words(words, terms):
+    """
+    Check whether every term is a prefix of some of the words.
+
+    Search without any terms (only punctuation) does not match anything.
+    """
+    if not terms:
+        return False
+    return all(any(word.startswith(term) for word in words) for term in terms)
+
+
+def invoice_matches(invoice, match):
+    """Check whether a loaded invoice matches the search string."""
+    words = invoice_terms(invoice)
+    words.update(tokenize(invoice.contact["name"]))
+    return match_words(words, tokenize(match))
+
+
+def connect(path):
+    """Open the storage database, (re)creating the schema if needed."""
+    connection = sqlite3.connect(path, timeout=30)
+    connection.row_factory = sqlite3.Row
+    (version,) = connection.execute("PRAGMA user_version").fetchone()
+    if version != SCHEMA_VERSION:
+        connection.executescript(SCHEMA)
+    return connection
+
+
+class IndexedInvoice:
+    """Invoice header fields loaded from the index."""
+
+    def __init__(self, storage, row):
+        self.storage = storage
+        self.name = storage.path(row["filename"])
+        self.invoiceid = row["invoiceid"]
+        self.invoice = {field: row[field] for field in FIELDS}
+        self._paid = bool(row["paid"])
+
+    @cached_property
+    def contact(self):
+        contact = self.storage.read_contact(self.invoice["contact"])
+        for key, value in CONTACT.items():
+            if key not in contact:
+                contact[key] = value
+        return contact
+
+    @property
+    def category(self):
+        return self.invoice["category"]
+
+    @property
+    def amount(self):
+        return self.invoice["total"]
+
+    @property
+    def total_amount(self):
+        return self.invoice["total_sum"]
+
+    @property
+    def currency(self):
+        return self.invoice["currency"].split("-")[0]
+
+    @property
+    def amount_czk(self):
+        return float(self.invoice["total"]) * float(self.invoice["czk_rate"])
+
+    @property
+    def amount_czk_vat(self):
+        return float(self.invoice["total_sum"]) * float(self.invoice["czk_rate"])
+
+    def paid(self):
+        return self._paid
+
+
+class InvoiceIndex:
+    """
+    Persistent index of computed invoice header fields.
+
+    The index is stored in a SQLite database in the config directory and is
+    refreshed incrementally based on modification time and size of the
+    invoice files and of the contact and bank files the fields depend on.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.connection = storage.database
+
+    def relative(self, filename):
+        return os.path.relpath(filename, self.storage.basedir)
+
+    def build_row(self, filename, stat, paid):
+        """Create index row, the invoice fields are filled in by fill_row."""
+        return {
+            "filename": filename,
+            "series": self.storage.series,
+            "mtime": stat.st_mtime_ns,
+            "size": stat.st_size,
+            "paid": int(paid),
+        }
+
+    def fill_row(self, row, invoice):
+        row["invoiceid"] = invoice.invoiceid
+        for field in FIELDS:
+            row[field] = invoice.invoice[field]
+        # Contact provides defaults, bank overrides some of the fields
+        filenames = [
+            self.storage.contact_path(invoice.invoice["contact"]),
+            *self.storage.bank_paths(
+                invoice.invoice["currency"], invoice.invoice["bank_suffix"]
+            ),
+        ]
+        row["depends"] = json.dumps(
+            [
+                [self.relative(filename), self.storage.file_stamp(filename)]
+                for filename in filenames
+            ]
+        )
+
+    def dependencies_changed(self, row, stamps):
+        """Check stamps of files the row depends on, stamps are memoized."""
+        for filename, stamp in json.loads(row["depends"]):
+            if filename not in stamps:
+                current = self.storage.file_stamp(self.storage.path(filename))
+                stamps[filename] = None if current is None else list(current)
+            if stamps[filename] != stamp:
+                return True
+        return False
+
+    @timed("index")
+    def refresh(self, year=None, month=None, jobs=None):
+        """
+        Update index for given period and return its rows in order.
+
+        Changed invoices are loaded by a process pool with more than one job.
+        """
+        filenames = [self.relative(name) for name in self.storage.glob(year, month)]
+        known = {
+            row["filename"]: row
+            for row in self.connection.execute(
+                "SELECT * FROM invoices WHERE series = ?", (self.storage.series,)
+            )
+        }
+        paid_index = self.storage.paid_index(year)
+        result = []
+        updates = []
+        changed = []
+        paid_updates = []
+        stamps = {}
+        for filename in filenames:
+            fullname = self.storage.path(filename)
+            stat = os.stat(fullname)
+            paid = int(os.path.splitext(os.path.basename(filename))[0] in paid_index)
+            row = known.get(filename)
+            if (
+                row is None
+                or row["mtime"] != stat.st_mtime_ns
+                or row["size"] != stat.st_size
+                or self.dependencies_changed(row, stamps)
+            ):
+                cache("index", hit=False)
+                row = self.build_row(filename, stat, paid)
+                updates.append(row)
+                changed.append(fullname)
+            else:
+                cache("index", hit=True)
+                if row["paid"] != paid:
+                    row = dict(row)
+                    row["paid"] = paid
+                    paid_updates.append((paid, filename))
+            result.append(row)
+
+        # Load changed invoices, serially with exchange rates resolved upfront
+        parallel = (jobs or 1) > 1
+        invoices = list(
+            self.storage.load(
+                changed,
+                [bool(row["paid"]) for row in updates],
+                lazy=not parallel,
+                jobs=jobs,
+            )
+        )
+        if not parallel:
+            self.storage.prefetch_rates(invoices)
+
+        current = set(filenames)
+        stale = [
+            (filename,)
+            for filename in known
+            if filename not in current
+            and self.storage.in_period(
+                self.storage.parse_filename(os.path.basename(filename)), year, month
+            )
+        ]
+
+        if updates or paid_updates or stale:
+            self.store(updates, invoices, paid_updates, stale)
+        return result
+
+    def store(self, updates, invoices, paid_updates=(), stale=()):
+        """Write updated rows with their loaded invoices to the database."""
+        terms = []
+        for row, invoice in zip(updates, invoices, strict=True):
+            self.fill_row(row, invoice)
+            terms.extend((term, row["filename"]) for term in invoice_terms(invoice))
+        columns = ("filename", "series", "mtime", "size", "paid", "invoiceid")
+        columns += ("depends",)
+        columns += FIELDS
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO invoices ({}) VALUES ({})".format(  # noqa: S608
+                    ", ".join(columns), ", ".join(f":{name}" for name in columns)
+                ),
+                updates,
+            )
+            self.connection.executemany(
+                "UPDATE invoices SET paid = ? WHERE filename = ?", paid_updates
+            )
+            self.connection.executemany(
+                "DELETE FROM invoices WHERE filename = ?", stale
+            )
+            self.connection.executemany(
+                "DELETE FROM terms WHERE filename = ?",
+                [(row["filename"],) for row in updates] + list(stale),
+            )
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO terms (term, filename) VALUES (?, ?)", terms
+            )
+
+    def search(self, match):
+        """
+        Return filenames of indexed invoices matching the search string.
+
+        Every word of the search string has to be a prefix of some word of
+        the invoice items, remarks, contact key or contact name. Only the
+        contact files are read, the invoices are matched in the database.
+        """
+        terms = set(tokenize(match))
+        # Nothing matches search without words, see match_words
+        if not terms:
+            return set()
+        contacts = {
+            row["contact"]: tokenize(
+                self.storage.read_contact(row["contact"]).get("name", "")
+            )
+            for row in self.connection.execute(
+                "SELECT DISTINCT contact FROM invoices WHERE series = ?",
+                (self.storage.series,),
+            )
+        }
+        result = None
+        for term in terms:
+            filenames = {
+                row["filename"]
+                for row in self.connection.execute(
+                    "SELECT filename FROM terms WHERE term >= ? AND term < ?",
+                    (term, term + PREFIX_END),
+                )
+            }
+            names = [
+                contact
+                for contact, words in contacts.items()
+                if match_words(words, [term])
+            ]
+            if names:
+                placeholders = ", ".join("?" * len(names))
+                filenames.update(
+                    row["filename"]
+                    for row in self.connection.execute(
+                        "SELECT filename FROM invoices "  # noqa: S608
+                        f"WHERE series = ? AND contact IN ({placeholders})",
+                        (self.storage.series, *names),
+                    )
+                )
+            result = filenames if result is None else result & filenames
+        return result
+
+    def list(self, year=None, month=None, jobs=None, match=None):
+        """Yield indexed invoices, optionally only the ones matching search."""
+        rows = self.refresh(year, month, jobs)
+        found = self.search(match) if match else None
+        for row in rows:
+            if found is None or row["filename"] in found:
+                yield IndexedInvoice(self.storage, row)
+
+
+class BuildCache:
+    """Hashes of inputs and outputs of the tex and PDF builds."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.connection = storage.database
+
+    def relative(self, filename):
+        return os.path.relpath(filename, self.storage.basedir)
+
+    def get(self, filename):
+        row = self.connection.execute(
+            "SELECT inputs, tex, pdf FROM builds WHERE filename = ?",
+            (self.relative(filename),),
+        ).fetchone()
+        if row is None:
+            return {"inputs": None, "tex": None, "pdf": None}
+        return dict(row)
+
+    def update(self, filename, **kwargs):
+        state = self.get(filename)
+        state.update(kwargs)
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO builds (filename, inputs, tex, pdf) "
+                "VALUES (?, ?, ?, ?)",
+                (self.relative(filename), state["inputs"], state["tex"], state["pdf"]),
+            )
+
+
+class Sequences:
+    """Last allocated invoice numbers for each series and period."""
+
+    def __init__(self, storage):
+        self.storage = storage
+        self.connection = storage.database
+
+    def get(self, period):
+        row = self.connection.execute(
+            "SELECT last FROM sequences WHERE series = ? AND period = ?",
+            (self.storage.series, period),
+        ).fetchone()
+        if row is None:
+            return None
+        return row["last"]
+
+    def set(self, period, last):
+        with self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sequences (series, period, last) "
+                "VALUES (?, ?, ?)",
+                (self.storage.series, period, last),
+            )
@@ -1,46 +1,176 @@
+import hashlib
+import json
 import os
 import subprocess
 from configparser import RawConfigParser
-
-from django.utils.functional import cached_property
-from jinja2.exceptions import TemplateNotFound
+from functools import cached_property
 
 from .data import CONTACT, DEFAULTS
 from .rates import Rates
+from .timing import phase, timed
+
+# Fields which can be overridden by the bank
+BANK_FIELDS = ("template", "note", "vat")
+
+
+class InvoiceData(dict):
+    """
+    Invoice data computing the derived fields on first access.
+
+    Any access to a missing field or to all of the fields computes them,
+    header_items gives the fields parsed from the file without that.
+    """
+
+    def __init__(self, data, loader):
+        super().__init__(data)
+        self.loader = loader
+
+    def load(self):
+        if self.loader is not None:
+            self.loader()
+
+    def __missing__(self, key):
+        if self.loader is None:
+            raise KeyError(key)
+        self.loader()
+        return self[key]
+
+    def __contains__(self, key):
+        if not super().__contains__(key):
+            self.load()
+        return super().__contains__(key)
+
+    def get(self, key, default=None):
+        if not super().__contains__(key):
+            self.load()
+        return super().get(key, default)
+
+    def __iter__(self):
+        self.load()
+        return super().__iter__()
+
+    def __len__(self):
+        self.load()
+        return super().__len__()
+
+    def __eq__(self, other):
+        self.load()
+        if isinstance(other, InvoiceData):
+            other.load()
+        return super().__eq__(other)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def keys(self):
+        self.load()
+        return super().keys()
+
+    def values(self):
+        self.load()
+        return super().values()
+
+    def items(self):
+        self.load()
+        return super().items()
+
+    def copy(self):
+        self.load()
+        return dict(super().items())
+
+    def header_items(self):
+        """Return fields loaded so far, without computing the rest."""
+        return super().items()
+
+
+def render_rows(template, rows):
+    """
+    Render a template for each row and join the results.
+
+    This is equivalent to joining template.render(row) results, but skips
+    per call overhead of render by reusing the compiled render function.
+    """
+    environment = template.environment
+    render = template.root_render_func
+    new_context = template.new_context
+    try:
+        return "\n".join(environment.concat(render(new_context(row))) for row in rows)
+    except Exception:  # noqa: BLE001
+        return environment.handle_exception()
 
 
 class Invoice:
-    def __init__(self, storage, data, override=None):
+    def __init__(self, storage, data, override=None, *, lazy=False, paid=None):
         self.name = data
         self.storage = storage
+        # Paid status resolved by the storage, see InvoiceStorage.paid_index
+        self._paid = paid
         self.contact = {}
         self.invoice = {}
-        self.bank = {}
+        self.pending = {}
+        self._bank = None
         if override is None:
             self.override = {}
         else:
             self.override = override
-        self.load()
+        self.load_header()
+        if not lazy:
+            self.load_details()
+
+    def __getstate__(self):
+        """Storage is not pickled, it is attached again by InvoiceStorage.load."""
+        state = self.__dict__.copy()
+        del state["storage"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.storage = None
 
     def load(self):
         """Load data from ini files."""
-        data = RawConfigParser()
-        data.read(self.name)
+        self.load_header()
+        self.load_details()
 
-        self.invoice = dict(data["invoice"])
+    def load_header(self):
+        """Load invoice header and contact, details are computed on access."""
+        with phase("invoice"):
+            data = RawConfigParser()
+            data.read(self.name)
+
+        self.invoice = InvoiceData(data["invoice"], None)
+        self._bank = None
 
         self.contact = self.storage.read_contact(self.invoice["contact"])
 
         self.process_defaults()
 
-        self.bank = self.storage.read_bank(
+        # These are finalized only once bank is loaded
+        self.pending = {field: self.invoice.pop(field) for field in BANK_FIELDS}
+        self.invoice.loader = self.load_details
+
+    @property
+    def bank(self):
+        self.load_details()
+        return self._bank
+
+    def load_details(self):
+        """Compute bank, invoice rows, totals and exchange rates."""
+        if self._bank is not None:
+            return
+        self.invoice.loader = None
+        self.invoice.update(self.pending)
+
+        self._bank = self.storage.read_bank(
             self.invoice["currency"],
             self.invoice["bank_suffix"],
         )
         # Propagate defaults from bank
-        for field in ("template", "note", "vat"):
-            if field in self.bank:
-                self.invoice[field] = self.bank[field]
+        for field in BANK_FIELDS:
+            if field in self._bank:
+                self.invoice[field] = self._bank[field]
 
         # Fetch invoice rows
         self.invoice["rows_data"] = []
@@ -81,7 +211,7 @@ class Invoice:
                     "rate": f"{rate:.2f}",
                     "quantity": quantity,
                     "total": f"{total:.2f}",
-                    "currency": self.bank.get("currency", self.invoice["currency"]),
+                    "currency": self._bank.get("currency", self.invoice["currency"]),
                 },
             )
 
@@ -144,37 +274,109 @@ class Invoice:
     def pdf_path(self):
         return self.storage.path(self.storage.pdf, f"{self.invoiceid}.pdf")
 
-    def write_tex(self):
-        row_template = self.storage.jinja.get_template(self.invoice["row"])
-
+    def get_templates(self):
+        """Return names of the category, base and row templates."""
         category_template = self.invoice["template"].replace(
             ".tex",
             f"-{self.category}.tex",
         )
+        return category_template, self.invoice["template"], self.invoice["row"]
+
+    def tex_inputs(self):
+        """Return hash of all inputs used for rendering the tex."""
+        self.load_details()
+        digest = hashlib.sha256()
+        data = {
+            "invoiceid": self.invoiceid,
+            "contact": self.contact,
+            "invoice": self.invoice,
+            "bank": self.bank,
+        }
+        digest.update(json.dumps(data, sort_keys=True, default=str).encode())
+        for name in self.get_templates():
+            digest.update(f"{name}:{self.storage.template_hash(name)}\n".encode())
+        return digest.hexdigest()
+
+    @timed("render")
+    def write_tex(self, *, force=False):
+        """Render tex, returns False if it was already up to date."""
+        inputs = self.tex_inputs()
+        state = self.storage.builds.get(self.tex_path)
+        if not force and state["inputs"] == inputs and os.path.exists(self.tex_path):
+            return False
+
+        category_template, base_template, row = self.get_templates()
+        row_template = self.storage.jinja.get_template(row)
+
+        template = self.storage.jinja.select_template(
+            [category_template, base_template]
+        )
 
-        try:
-            template = self.storage.jinja.get_template(category_template)
-        except TemplateNotFound:
-            template = self.storage.jinja.get_template(self.invoice["template"])
-
-        rows = [row_template.render(row) for row in self.invoice["rows_data"]]
+        rows = render_rows(row_template, self.invoice["rows_data"])
 
-        context = {"invoiceid": self.invoiceid, "rows": "\n".join(rows)}
+        context = {"invoiceid": self.invoiceid, "rows": rows}
         context.update(self.contact)
         context.update(self.invoice)
         context.update(self.bank)
         output = template.render(context)
-        self.storage.ensure_dir(self.tex_path)
-        with open(self.tex_path, "w") as handle:
-            handle.write(output)
-
-    def build_pdf(self):
+        digest = hashlib.sha256(output.encode()).hexdigest()
+        # Keep the file untouched if the content did not change
+        if force or digest != self.file_hash(self.tex_path):
+            self.storage.ensure_dir(self.tex_path)
+            with open(self.tex_path, "w") as handle:
+                handle.write(output)
+        self.storage.builds.update(self.tex_path, inputs=inputs, tex=digest)
+        return True
+
+    @staticmethod
+    def file_hash(filename):
+        try:
+            with open(filename, "rb") as handle:
+                return hashlib.sha256(handle.read()).hexdigest()
+        except FileNotFoundError:
+            return None
+
+    def build_pdf(self, workdir=None, *, force=False):
+        """
+        Build PDF from the generated tex, returns False if it was up to date.
+
+        When workdir (relative to the PDF directory) is given, the auxiliary
+        files are written there, the output is captured and xelatex is never
+        interactive. This allows running several builds in parallel.
+        """
+        digest = self.file_hash(self.tex_path)
+        state = self.storage.builds.get(self.tex_path)
+        if not force and state["pdf"] == digest and os.path.exists(self.pdf_path):
+            return False
         self.storage.ensure_dir(self.pdf_path)
-        subprocess.run(
-            ["xelatex", os.path.abspath(self.tex_path)],
-            check=True,
-            cwd=self.storage.path(self.storage.pdf),
-        )
+        cwd = self.storage.path(self.storage.pdf)
+        with phase("xelatex"):
+            if workdir is None:
+                subprocess.run(
+                    ["xelatex", os.path.abspath(self.tex_path)],
+                    check=True,
+                    cwd=cwd,
+                )
+            else:
+                subprocess.run(
+                    [
+                        "xelatex",
+                        "-interaction=nonstopmode",
+                        "-halt-on-error",
+                        f"-output-directory={workdir}",
+                        os.path.abspath(self.tex_path),
+                    ],
+                    check=True,
+                    cwd=cwd,
+                    stdin=subprocess.DEVNULL,
+                    capture_output=True,
+                )
+                os.replace(
+                    os.path.join(cwd, workdir, f"{self.invoiceid}.pdf"),
+                    self.pdf_path,
+                )
+        self.storage.builds.update(self.tex_path, pdf=digest)
+        return True
 
     @property
     def category(self):
@@ -186,9 +388,7 @@ class Invoice:
 
     @property
     def total_amount(self):
-        if "total_sum" in self.invoice:
-            return self.invoice["total_sum"]
-        return self.invoice["total"]
+        return self.invoice["total_sum"]
 
     @property
     def currency(self):
@@ -210,26 +410,25 @@ class Invoice:
     @property
     def amount_czk_vat(self):
         rate = Rates.get(self.invoice["date"], self.currency)
-        if "total_sum" in self.invoice:
-            total = self.invoice["total_sum"]
-        else:
-            total = self.invoice["total"]
-        return float(total) * rate
+        return float(self.invoice["total_sum"]) * rate
 
     def paid(self):
-        return os.path.exists(self.name.replace(".ini", ".paid"))
+        if self._paid is None:
+            return os.path.exists(self.name.replace(".ini", ".paid"))
+        return self._paid
 
     @cached_property
     def paid_path(self):
-        return self.storage.path(self.storage.data, f"{self.invoiceid}.paid")
+        return os.path.splitext(self.name)[0] + ".paid"
 
     def mark_paid(self, text):
         with open(self.paid_path, "w") as handle:
             handle.write(text)
+        self._paid = True
 
 
 class Quote(Invoice):
-    def __init__(self, storage, data):
+    def __init__(self, storage, data, **kwargs):
         super().__init__(
             storage,
             data,
@@ -240,11 +439,12 @@ class Quote(Invoice):
                     "please contact us at sales@weblate.org."
                 ),
             },
+            **kwargs,
         )
 
 
 class Proforma(Invoice):
-    def __init__(self, storage, data):
+    def __init__(self, storage, data, **kwargs):
         super().__init__(
             storage,
             data,
@@ -255,6 +455,7 @@ class Proforma(Invoice):
                     "you will receive proper invoice upon payment."
                 ),
             },
+            **kwargs,
         )
 
     def process_defaults(self):
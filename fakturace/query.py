@@ -0,0 +1,96 @@
+"""Queries over several series and years."""
+
+from __future__ import annotations
+
+from .index import invoice_matches
+from .storage import InvoiceStorage, ProformaStorage, QuoteStorage, WebStorage
+
+SERIES = {
+    storage_class.series: storage_class
+    for storage_class in (InvoiceStorage, QuoteStorage, WebStorage, ProformaStorage)
+}
+
+
+def parse_years(value):
+    """Parse years specification like 2024, 2019-2026 or 2019,2021."""
+    years = set()
+    for part in value.split(","):
+        start, _separator, end = part.partition("-")
+        try:
+            first = int(start)
+            last = int(end) if end else first
+        except ValueError as error:
+            raise ValueError(f"Invalid years: {value}") from error
+        if last < first:
+            raise ValueError(f"Invalid years: {value}")
+        years.update(range(first, last + 1))
+    return sorted(years)
+
+
+def parse_series(value):
+    """Parse comma separated list of series names."""
+    names = [name.strip() for name in value.split(",")]
+    for name in names:
+        if name not in SERIES:
+            choices = ", ".join(SERIES)
+            raise ValueError(f"Invalid series: {name}, choose from {choices}")
+    return names
+
+
+def create_storages(names, basedir="."):
+    """Create storages for series sharing their caches."""
+    first = SERIES[names[0]](basedir)
+    return [first, *(first.sibling(SERIES[name]) for name in names[1:])]
+
+
+class Query:
+    """
+    Invoices of several series over several years.
+
+    Only the query years are scanned and refreshed in the index, so that
+    reports over few years do not process the whole archive.
+    """
+
+    def __init__(self, storages, years=None):
+        self.storages = storages
+        self.years = None if years is None else sorted(set(years))
+
+    @property
+    def scopes(self):
+        """Years to pass to the storage, None covers all years."""
+        return [None] if self.years is None else self.years
+
+    def filenames(self, storage):
+        """Return invoice filenames of a storage in the query years."""
+        return [filename for year in self.scopes for filename in storage.glob(year)]
+
+    def invoices(self, jobs=None, match=None):
+        """
+        Yield invoices with header fields loaded from the index.
+
+        The match is looked up in the index search terms, see
+        InvoiceIndex.search.
+        """
+        for storage in self.storages:
+            for year in self.scopes:
+                yield from storage.index.list(year, jobs=jobs, match=match)
+
+    def contacts(self, jobs=None, match=None):
+        """Return mapping of contact keys to ids of their invoices."""
+        result = {}
+        for invoice in self.invoices(jobs=jobs, match=match):
+            result.setdefault(invoice.invoice["contact"], []).append(invoice.invoiceid)
+        return result
+
+    def list(self, *, lazy=False, jobs=None, match=None):
+        """Yield invoices loaded from the files, see InvoiceStorage.load."""
+        for storage in self.storages:
+            filenames = []
+            paid = []
+            for year in self.scopes:
+                names = storage.glob(year)
+                filenames.extend(names)
+                paid.extend(storage.paid_flags(names, year))
+            for invoice in storage.load(filenames, paid, lazy=lazy, jobs=jobs):
+                if not match or invoice_matches(invoice, match):
+                    yield invoice
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import datetime
 import json
 import os
+import time
 from decimal import Decimal
-from typing import ClassVar
-from urllib.request import urlopen
+from typing import TYPE_CHECKING, ClassVar
 
-from fakturace.data import CACHE_DIR, RATE_URL
+from fakturace.data import CACHE_DIR, RATE_URL, RATE_YEAR_URL
+from fakturace.timing import cache, timed
+
+if TYPE_CHECKING:
+    from collections.abc import Iterable
 
 
 class DecimalEncoder(json.JSONEncoder):
@@ -17,15 +22,105 @@ class DecimalEncoder(json.JSONEncoder):
 
 
 class DecimalRates:
-    datacache: ClassVar[dict[str, float]] = {}
+    datacache: ClassVar[dict[str, dict[str, Decimal]]] = {}
+    years: ClassVar[set[str]] = set()
+    cache_dir: ClassVar[str] = CACHE_DIR
+    url: ClassVar[str] = RATE_URL
+    year_url: ClassVar[str] = RATE_YEAR_URL
+    # Network settings
+    timeout: ClassVar[float] = 30
+    retries: ClassVar[int] = 2
+    retry_delay: ClassVar[float] = 1
+    jobs: ClassVar[int] = 8
+
+    @classmethod
+    def ensure_cache_dir(cls) -> None:
+        if not os.path.exists(cls.cache_dir):
+            os.makedirs(cls.cache_dir)
+
+    @classmethod
+    def year_cache_file(cls, year: str) -> str:
+        return os.path.join(cls.cache_dir, f"rates-year-{year}")
+
+    @classmethod
+    def load_year(cls, year: str) -> None:
+        """Load consolidated cache for a year, see prefetch."""
+        if year in cls.years:
+            return
+        cls.years.add(year)
+        cache_file = cls.year_cache_file(year)
+        if not os.path.exists(cache_file):
+            return
+        with open(cache_file) as handle:
+            data = json.load(handle)
+        for date, rates in data.items():
+            if date not in cls.datacache:
+                cls.datacache[date] = {
+                    key: Decimal(value) for key, value in rates.items()
+                }
+
+    @classmethod
+    def prefetch(cls, year: int) -> int:
+        """
+        Download rates for the whole year and store them in a single file.
+
+        Days without published rates (weekends and holidays) use the last
+        published rates like the daily rates do. Returns number of days stored.
+        """
+        from urllib.request import urlopen  # noqa: PLC0415
+
+        handle = urlopen(cls.year_url.format(year), timeout=cls.timeout)
+        content = handle.read().decode("utf-8")
+        published = {}
+        codes = []
+        for line in content.splitlines():
+            if "|" not in line:
+                continue
+            parts = line.split("|")
+            # The header is repeated whenever list of currencies changes
+            if parts[0] == "Datum":
+                codes = [part.split()[-1] for part in parts[1:]]
+                continue
+            date = datetime.datetime.strptime(parts[0], "%d.%m.%Y").date()  # noqa: DTZ007
+            published[date] = {
+                code: Decimal(value.replace(",", "."))
+                for code, value in zip(codes, parts[1:], strict=True)
+            }
+
+        result = {}
+        if published:
+            # Days after the last published rates are complete only for past years
+            if year < datetime.date.today().year:
+                end = datetime.date(year, 12, 31)
+            else:
+                end = max(published)
+            rates = None
+            day = min(published)
+            while day <= end:
+                rates = published.get(day, rates)
+                result[day.isoformat()] = rates
+                day += datetime.timedelta(days=1)
+
+        cls.ensure_cache_dir()
+        with open(cls.year_cache_file(str(year)), "w") as handle:
+            json.dump(result, handle, cls=DecimalEncoder)
+        cls.datacache.update(result)
+        cls.years.add(str(year))
+        return len(result)
+
+    @classmethod
+    def daily_cache_file(cls, date: str) -> str:
+        return os.path.join(cls.cache_dir, f"rates-{date}")
 
     @classmethod
-    def download(cls, date: str) -> dict[str, dict[str, Decimal]]:
-        if not os.path.exists(CACHE_DIR):
-            os.makedirs(CACHE_DIR)
-        cache_file = os.path.join(CACHE_DIR, f"rates-{date}")
+    def load_cached(cls, date: str) -> bool:
+        """Load rates from the caches, returns False if they are not cached."""
+        # Consolidated year cache
+        if date not in cls.datacache:
+            cls.load_year(date[:4])
 
         # Filesystem cache
+        cache_file = cls.daily_cache_file(date)
         if date not in cls.datacache and os.path.exists(cache_file):
             with open(cache_file) as handle:
                 # Convert str (from DecimalEncoder) or float (legacy cache) to Decimal
@@ -33,27 +128,67 @@ class DecimalRates:
                     key: Decimal(value) for key, value in json.load(handle).items()
                 }
 
-        # Load remotely
-        if date not in cls.datacache:
-            cls.datacache[date] = {}
-            parts = date.split("-")
-            handle = urlopen(RATE_URL.format(*parts))
-            content = handle.read().decode("utf-8")
-            for line in content.splitlines():
-                if "|" not in line:
-                    continue
-                parts = line.split("|")
-                if parts[4] in ("kurz", "Rate"):
-                    continue
-                cls.datacache[date][parts[3]] = Decimal(parts[4].replace(",", "."))
-
-            # Update filesystem cache
-            with open(cache_file, "w") as handle:
-                json.dump(cls.datacache[date], handle, cls=DecimalEncoder)
+        return date in cls.datacache
+
+    @classmethod
+    @timed("rates.fetch")
+    def fetch(cls, date: str) -> dict[str, Decimal]:
+        """Download rates for a date, retrying on failures."""
+        from urllib.request import urlopen  # noqa: PLC0415
 
+        parts = date.split("-")
+        for attempt in range(cls.retries + 1):
+            try:
+                handle = urlopen(cls.url.format(*parts), timeout=cls.timeout)
+                content = handle.read().decode("utf-8")
+                break
+            except OSError:
+                if attempt == cls.retries:
+                    raise
+                time.sleep(cls.retry_delay * (attempt + 1))
+        result = {}
+        for line in content.splitlines():
+            if "|" not in line:
+                continue
+            parts = line.split("|")
+            if parts[4] in ("kurz", "Rate"):
+                continue
+            result[parts[3]] = Decimal(parts[4].replace(",", "."))
+        return result
+
+    @classmethod
+    def store(cls, date: str, rates: dict[str, Decimal]) -> None:
+        cls.datacache[date] = rates
+        # Update filesystem cache
+        cls.ensure_cache_dir()
+        with open(cls.daily_cache_file(date), "w") as handle:
+            json.dump(rates, handle, cls=DecimalEncoder)
+
+    @classmethod
+    def download(cls, date: str) -> dict[str, Decimal]:
+        cached = cls.load_cached(date)
+        cache("rates", hit=cached)
+        if not cached:
+            cls.store(date, cls.fetch(date))
         return cls.datacache[date]
 
     @classmethod
+    @timed("rates")
+    def resolve(cls, dates: Iterable[str], jobs: int | None = None) -> None:
+        """Make rates for all dates available, missing ones are fetched concurrently."""
+        missing = [date for date in sorted(set(dates)) if not cls.load_cached(date)]
+        if not missing:
+            return
+        from concurrent.futures import ThreadPoolExecutor  # noqa: PLC0415
+
+        with ThreadPoolExecutor(max_workers=jobs or cls.jobs) as executor:
+            for date, rates in zip(
+                missing, executor.map(cls.fetch, missing), strict=True
+            ):
+                cls.store(date, rates)
+
+    @classmethod
+    @timed("rates")
     def get(cls, date: str, currency: str) -> Decimal:
         if currency == "CZK":
             return 1
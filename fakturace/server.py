@@ -0,0 +1,75 @@
+"""
+Unix socket server executing commands with resident storages.
+
+The protocol is a single JSON line in each direction, the request contains
+command line arguments as {"args": [...]}, the response contains the command
+output as {"status": 0, "stdout": "...", "stderr": "..."}.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import socket
+from socketserver import StreamRequestHandler, UnixStreamServer
+
+
+class RequestHandler(StreamRequestHandler):
+    def handle(self):
+        line = self.rfile.readline()
+        # Probe from connect
+        if not line:
+            return
+        request = json.loads(line)
+        response = self.server.execute(request["args"])
+        self.wfile.write(json.dumps(response).encode() + b"\n")
+
+
+class Server(UnixStreamServer):
+    """
+    Server handling one request at a time.
+
+    Commands write to the redirected stdout and share the storage caches, so
+    they can not run concurrently.
+    """
+
+    def __init__(self, path, execute):
+        if os.path.exists(path):
+            client = connect(path)
+            if client is not None:
+                client.close()
+                raise ValueError(f"Server is already running on {path}!")
+            # Stale socket left by a killed server
+            os.unlink(path)
+        self.path = path
+        self.execute = execute
+        super().__init__(path, RequestHandler)
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+def connect(path):
+    """Connect to the server, returns None if it is not running."""
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def request(path, args):
+    """Execute command on the server, returns None if it is not running."""
+    client = connect(path)
+    if client is None:
+        return None
+    with client, client.makefile("rwb") as handle:
+        handle.write(json.dumps({"args": args}).encode() + b"\n")
+        handle.flush()
+        return json.loads(handle.readline())
@@ -1,40 +1,141 @@
 from __future__ import annotations
 
 import datetime
+import hashlib
 import os
 import re
+import shutil
+import subprocess
+import time
+from collections import deque
 from configparser import RawConfigParser
-from glob import glob
-
-import jinja2
-from django.utils.functional import cached_property
-from filelock import FileLock
+from contextlib import suppress
+from functools import cached_property, lru_cache
+from string import Formatter
+from tempfile import TemporaryDirectory, mkstemp
 
+from .index import BuildCache, InvoiceIndex, Sequences, connect
 from .invoices import Invoice, Proforma, Quote
-
-LATEX_SUBS = (
-    (re.compile(r"\\"), r"\\textbackslash"),
-    (re.compile(r"([{}_#%&$])"), r"\\\1"),
-    (re.compile(r"~"), r"\~{}"),
-    (re.compile(r"\^"), r"\^{}"),
-    (re.compile(r'"'), r"''"),
-    (re.compile(r"\.\.\.+"), r"\\ldots"),
-)
+from .rates import DecimalRates
+from .timing import cache, phase, timed
+
+LATEX_RE = re.compile(r'\.\.\.+|[\\{}_#%&$~^"]')
+LATEX_SUBS = {
+    "\\": r"\textbackslash",
+    "{": r"\{",
+    "}": r"\}",
+    "_": r"\_",
+    "#": r"\#",
+    "%": r"\%",
+    "&": r"\&",
+    "$": r"\$",
+    "~": r"\~{}",
+    "^": r"\^{}",
+    '"': "''",
+}
 
 DASH_RE = re.compile(r"-")
 
+# Directory timestamps younger than this are not trusted for caching
+RACY_NS = 2_000_000_000
+
+# Year directories of the partitioned layout
+YEAR_RE = re.compile(r"[0-9]{4}")
+
+TEMPLATE_FIELDS = {
+    "year": r"(?P<year>[0-9]{2})",
+    "month": r"(?P<month>[0-9]{2})",
+    "full_year": r"(?P<full_year>[0-9]{4})",
+    "order": r"(?P<order>.*)",
+}
+
+
+def latex_replace(match):
+    # Anything not listed is an ellipsis
+    return LATEX_SUBS.get(match.group(0), r"\ldots")
+
 
+@lru_cache(maxsize=4096)
 def escape_tex(value):
-    newval = value
-    for pattern, replacement in LATEX_SUBS:
-        newval = pattern.sub(replacement, newval)
-    return newval
+    """Escape LaTeX special chars in a single pass."""
+    return LATEX_RE.sub(latex_replace, value)
 
 
 def escape_dash(value):
     return DASH_RE.sub(r"--", value)
 
 
+@lru_cache
+def template_regex(template):
+    """Compile regular expression matching filenames generated by a template."""
+    regex = []
+    for literal, field, _spec, _conversion in Formatter().parse(template):
+        regex.append(re.escape(literal))
+        if field is not None:
+            regex.append(TEMPLATE_FIELDS[field])
+    return re.compile("".join(regex))
+
+
+ENVIRONMENTS = {}
+
+
+def get_environment(basedir, cache_dir):
+    """Return Jinja environment shared by storages using the same basedir."""
+    key = (os.path.abspath(basedir), os.path.abspath(cache_dir))
+    if key not in ENVIRONMENTS:
+        import jinja2  # noqa: PLC0415
+
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        environment = jinja2.Environment(
+            block_start_string=r"\BLOCK{",
+            block_end_string="}",
+            variable_start_string=r"\VAR{",
+            variable_end_string="}",
+            comment_start_string=r"\#{",
+            comment_end_string="}",
+            line_statement_prefix="%%",
+            line_comment_prefix="%#",
+            trim_blocks=True,
+            autoescape=False,
+            loader=jinja2.FileSystemLoader(key[0]),
+            bytecode_cache=jinja2.FileSystemBytecodeCache(key[1]),
+        )
+        environment.filters["escape_tex"] = escape_tex
+        environment.filters["escape_dash"] = escape_dash
+        ENVIRONMENTS[key] = environment
+    return ENVIRONMENTS[key]
+
+
+def build_pdf_job(storage_class, basedir, invoiceid, force):
+    """Generate tex and build PDF for single invoice in a separate scratch dir."""
+    storage = storage_class(basedir)
+    invoice = storage.get(invoiceid)
+    invoice.write_tex(force=force)
+    pdfdir = storage.path(storage.pdf)
+    storage.ensure_dir(invoice.pdf_path)
+    with TemporaryDirectory(dir=pdfdir, prefix="build-") as workdir:
+        try:
+            return invoice.build_pdf(os.path.basename(workdir), force=force)
+        except subprocess.CalledProcessError as error:
+            # Keep the log for inspection
+            log = os.path.join(workdir, f"{invoiceid}.log")
+            if os.path.exists(log):
+                shutil.move(log, os.path.join(pdfdir, f"{invoiceid}.log"))
+            raise ValueError(
+                f"xelatex failed with exit code {error.returncode}, see {invoiceid}.log"
+            ) from error
+
+
+def load_invoices_job(storage_class, basedir, filenames, paid, lazy):
+    """Load chunk of invoices in a worker process, see InvoiceStorage.load."""
+    storage = storage_class(basedir)
+    return [
+        storage.base(storage, filename, lazy=lazy, paid=flag)
+        for filename, flag in zip(filenames, paid, strict=True)
+    ]
+
+
 class InvoiceStorage:
     data = "data"
     pdf = "pdf"
@@ -43,6 +144,10 @@ class InvoiceStorage:
     contacts = "contacts"
     banks = "banks"
     default_due = 15
+    series = "invoice"
+    # Chunks per worker when loading invoices in parallel and their size limit
+    load_chunks = 4
+    load_chunk_size = 100
 
     template = "{year}{month}{order}.ini"
     order = "{:02d}"
@@ -51,24 +156,18 @@ class InvoiceStorage:
 
     def __init__(self, basedir="."):
         self.basedir = basedir
-        lockfile = self.path(self.config, "lock")
-        self.ensure_dir(lockfile)
-        self.lock = FileLock(lockfile)
-        self.jinja = jinja2.Environment(
-            block_start_string=r"\BLOCK{",
-            block_end_string="}",
-            variable_start_string=r"\VAR{",
-            variable_end_string="}",
-            comment_start_string=r"\#{",
-            comment_end_string="}",
-            line_statement_prefix="%%",
-            line_comment_prefix="%#",
-            trim_blocks=True,
-            autoescape=False,
-            loader=jinja2.FileSystemLoader(os.path.abspath(basedir)),
-        )
-        self.jinja.filters["escape_tex"] = escape_tex
-        self.jinja.filters["escape_dash"] = escape_dash
+        self.ini_cache = {}
+        self.hash_cache = {}
+        self.scan_cache = {}
+        self.ensure_dir(self.path(self.config, "lock"))
+
+    def sibling(self, storage_class):
+        """Return storage of another series sharing caches with this one."""
+        storage = storage_class(self.basedir)
+        storage.ini_cache = self.ini_cache
+        storage.hash_cache = self.hash_cache
+        storage.scan_cache = self.scan_cache
+        return storage
 
     @staticmethod
     def ensure_dir(filename):
@@ -79,87 +178,517 @@ class InvoiceStorage:
     def path(self, *args):
         return os.path.join(self.basedir, *args)
 
-    def glob(self, year=None, month=None):
-        if year:
-            full_year = str(year)
-            year = f"{year % 2000:02d}"
+    @staticmethod
+    def file_stamp(filename):
+        try:
+            stat = os.stat(filename)
+        except FileNotFoundError:
+            return None
+        return (stat.st_mtime_ns, stat.st_size)
+
+    def read_section(self, section, *filenames):
+        """Read ini section, parsed files are cached until modified."""
+        key = (section, filenames)
+        stamp = tuple(self.file_stamp(filename) for filename in filenames)
+        cached = self.ini_cache.get(key)
+        if cached is None or cached[0] != stamp:
+            cache("ini", hit=False)
+            with phase("ini"):
+                data = RawConfigParser()
+                data.read(filenames)
+                result = dict(data[section]) if data.has_section(section) else None
+            cached = self.ini_cache[key] = (stamp, result)
+        else:
+            cache("ini", hit=True)
+        if cached[1] is None:
+            return None
+        return dict(cached[1])
+
+    def template_hash(self, name):
+        """Return hash of a template file, None if it does not exist."""
+        filename = self.path(name)
+        stamp = self.file_stamp(filename)
+        if stamp is None:
+            return None
+        cached = self.hash_cache.get(filename)
+        if cached is None or cached[0] != stamp:
+            with open(filename, "rb") as handle:
+                digest = hashlib.sha256(handle.read()).hexdigest()
+            cached = self.hash_cache[filename] = (stamp, digest)
+        return cached[1]
+
+    def invalidate(self, filename):
+        """Remove cached data for given file."""
+        for key in list(self.ini_cache):
+            if filename in key[1]:
+                del self.ini_cache[key]
+
+    def parse_filename(self, name):
+        """Return (year, month) of an invoice filename, None if it is not one."""
+        match = template_regex(self.template).fullmatch(name)
+        if match is None:
+            return None
+        fields = match.groupdict()
+        if "full_year" in fields:
+            year = int(fields["full_year"])
+        else:
+            year = 2000 + int(fields["year"])
+        month = int(fields["month"]) if "month" in fields else None
+        return year, month
+
+    def scan(self, dirname):
+        """
+        Scan a data directory, cached until the directory is modified.
+
+        Returns tuple of year -> month -> filenames map of the invoices, set
+        of paid invoice ids and list of year subdirectories. Scans of a
+        directory modified just now are not cached as further changes might
+        not change its timestamp.
+        """
+        stamp = self.file_stamp(dirname)
+        # Storages of several series might share the cache, see sibling
+        key = (self.template, dirname)
+        cached = self.scan_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            cache("scan", hit=True)
+            return cached[1]
+        cache("scan", hit=False)
+        tree = {}
+        paid = set()
+        years = []
+        with phase("scan"):
+            try:
+                with os.scandir(dirname) as entries:
+                    for entry in entries:
+                        name = entry.name
+                        if name.endswith(".paid"):
+                            paid.add(name[:-5])
+                        elif YEAR_RE.fullmatch(name):
+                            if entry.is_dir():
+                                years.append(name)
+                        elif (parsed := self.parse_filename(name)) is not None:
+                            tree.setdefault(parsed[0], {}).setdefault(
+                                parsed[1], []
+                            ).append(os.path.join(dirname, name))
+            except FileNotFoundError:
+                pass
+        result = (tree, frozenset(paid), sorted(years))
+        if stamp is not None and time.time_ns() - stamp[0] > RACY_NS:
+            self.scan_cache[key] = (stamp, result)
+        return result
+
+    def listings(self, year=None):
+        """Return scans of the data directories holding invoices for a year."""
+        root = self.scan(self.path(self.data))
+        if year is None:
+            years = root[2]
+        elif str(year) in root[2]:
+            years = [str(year)]
         else:
-            full_year = "[0-9][0-9][0-9][0-9]"
-            year = "[0-9][0-9]"
-        month = f"{month:02d}" if month else "[0-9][0-9]"
-        mask = self.template.format(
-            year=year,
-            month=month,
-            order="*",
-            full_year=full_year,
+            years = []
+        return [root, *(self.scan(self.path(self.data, name)) for name in years)]
+
+    @property
+    def partitioned(self):
+        """Whether invoices are stored in per year directories, see migrate."""
+        return any(
+            self.scan(self.path(self.data, name))[0]
+            for name in self.scan(self.path(self.data))[2]
         )
-        return sorted(glob(self.path(self.data, mask)))
 
-    def list(self, year=None, month=None):
-        for filename in self.glob(year, month):
-            yield self.base(self, filename)
+    @staticmethod
+    def in_period(parsed, year=None, month=None):
+        """Whether parsed filename belongs to the period."""
+        return (
+            parsed is not None
+            and (year is None or parsed[0] == year)
+            and (month is None or parsed[1] is None or parsed[1] == month)
+        )
 
-    def get(self, invoice):
-        if "/" not in invoice:
-            return self.base(self, self.path(self.data, f"{invoice}.ini"))
-        return self.base(self, self.path(invoice))
+    @timed("glob")
+    def glob(self, year=None, month=None):
+        """Return sorted invoice filenames for the period."""
+        result = []
+        for tree, _paid, _years in self.listings(year):
+            for key in tree if year is None else (year,):
+                for key_month, filenames in tree.get(key, {}).items():
+                    if month is None or key_month is None or key_month == month:
+                        result.extend(filenames)
+        # Invoices in the data directory and year directories are ordered together
+        return sorted(result, key=os.path.basename)
+
+    def paid_index(self, year=None):
+        """Return set of paid invoice ids, collected by the directory scans."""
+        listings = self.listings(year)
+        if len(listings) == 1:
+            return listings[0][1]
+        return frozenset().union(*(paid for _tree, paid, _years in listings))
+
+    def list(self, year=None, month=None, *, lazy=False, jobs=None):
+        """Yield invoices for the period in order, see load for jobs."""
+        filenames = self.glob(year, month)
+        paid = self.paid_flags(filenames, year)
+        return self.load(filenames, paid, lazy=lazy, jobs=jobs)
+
+    def paid_flags(self, filenames, year=None):
+        """Return paid status of the invoice files, see paid_index."""
+        index = self.paid_index(year)
+        return [
+            os.path.splitext(os.path.basename(filename))[0] in index
+            for filename in filenames
+        ]
+
+    def load(self, filenames, paid, *, lazy=False, jobs=None):
+        """
+        Yield invoices for the filenames in order.
+
+        With more than one job the invoices are loaded in chunks by a process
+        pool, the workers share exchange rates only through the disk cache.
+        """
+        if (jobs or 1) <= 1 or len(filenames) <= 1:
+            for filename, flag in zip(filenames, paid, strict=True):
+                yield self.base(self, filename, lazy=lazy, paid=flag)
+            return
+
+        from concurrent.futures import ProcessPoolExecutor  # noqa: PLC0415
+
+        # Chunks per job for balancing, bounded in size to limit memory
+        size = min(
+            self.load_chunk_size, -(-len(filenames) // (jobs * self.load_chunks))
+        )
+        pending = deque()
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for start in range(0, len(filenames), size):
+                pending.append(
+                    executor.submit(
+                        load_invoices_job,
+                        type(self),
+                        self.basedir,
+                        filenames[start : start + size],
+                        paid[start : start + size],
+                        lazy,
+                    )
+                )
+                # Limit number of loaded chunks waiting to be consumed
+                if len(pending) >= 2 * jobs:
+                    yield from self.attach(pending.popleft().result())
+            while pending:
+                yield from self.attach(pending.popleft().result())
+
+    def attach(self, invoices):
+        """Attach invoices loaded in a worker process to the storage."""
+        for invoice in invoices:
+            invoice.storage = self
+            yield invoice
+
+    def invoice_path(self, invoiceid):
+        """Return filename of an invoice in either of the layouts."""
+        name = f"{invoiceid}.ini"
+        parsed = self.parse_filename(name)
+        if parsed is not None:
+            filename = self.path(self.data, str(parsed[0]), name)
+            if os.path.exists(filename):
+                return filename
+        return self.path(self.data, name)
+
+    def migrate(self, *, partitioned=True):
+        """
+        Move invoices to per year directories or back to the flat layout.
+
+        Returns list of (old, new) filenames of moved invoices.
+        """
+        moves = []
+        with self.lock:
+            for filename in self.glob():
+                name = os.path.basename(filename)
+                if partitioned:
+                    dirname = self.path(self.data, str(self.parse_filename(name)[0]))
+                else:
+                    dirname = self.path(self.data)
+                target = os.path.join(dirname, name)
+                if target == filename:
+                    continue
+                if os.path.exists(target):
+                    raise ValueError(f"Invoice {target} already exists!")
+                os.makedirs(dirname, exist_ok=True)
+                os.rename(filename, target)
+                marker = os.path.splitext(filename)[0] + ".paid"
+                if os.path.exists(marker):
+                    os.rename(marker, os.path.splitext(target)[0] + ".paid")
+                moves.append((filename, target))
+            if not partitioned:
+                # Remove year directories unless used by other series
+                for name in self.scan(self.path(self.data))[2]:
+                    with suppress(OSError):
+                        os.rmdir(self.path(self.data, name))
+        self.scan_cache.clear()
+        return moves
+
+    def build_pdfs(self, invoiceids, jobs=None, *, force=False):
+        """
+        Build PDFs in a process pool.
+
+        Yields (invoiceid, built, error) tuples in order of completion. The
+        built flag is False for PDFs which were up to date, the error is None
+        on success.
+        """
+        from concurrent.futures import (  # noqa: PLC0415
+            ProcessPoolExecutor,
+            as_completed,
+        )
+
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            futures = {
+                executor.submit(
+                    build_pdf_job, type(self), self.basedir, invoiceid, force
+                ): invoiceid
+                for invoiceid in invoiceids
+            }
+            for future in as_completed(futures):
+                try:
+                    built = future.result()
+                except Exception as error:  # noqa: BLE001
+                    yield futures[future], False, error
+                else:
+                    yield futures[future], built, None
+
+    @cached_property
+    def jinja(self):
+        return get_environment(self.basedir, self.path(self.config, "jinja-cache"))
+
+    @cached_property
+    def lock(self):
+        from filelock import FileLock  # noqa: PLC0415
+
+        return FileLock(self.path(self.config, "lock"))
+
+    @cached_property
+    def database(self):
+        filename = self.path(self.config, "index.sqlite")
+        self.ensure_dir(filename)
+        # Avoid concurrent schema initialization
+        with self.lock:
+            return connect(filename)
+
+    @cached_property
+    def index(self):
+        return InvoiceIndex(self)
+
+    @cached_property
+    def builds(self):
+        return BuildCache(self)
 
     @cached_property
+    def sequences(self):
+        return Sequences(self)
+
+    @staticmethod
+    def prefetch_rates(invoices):
+        """Fetch exchange rates needed by the invoices concurrently."""
+        DecimalRates.resolve(
+            invoice.invoice["date"] for invoice in invoices if invoice.currency != "CZK"
+        )
+
+    def get(self, invoice, *, lazy=False):
+        if "/" not in invoice:
+            return self.base(self, self.invoice_path(invoice), lazy=lazy)
+        return self.base(self, self.path(invoice), lazy=lazy)
+
+    @property
     def settings(self):
-        data = RawConfigParser()
-        data.read(self.path(self.config, "config.ini"))
-        return dict(data["config"])
+        """Configuration, cached until config.ini is modified."""
+        settings = self.read_section("config", self.path(self.config, "config.ini"))
+        if settings is None:
+            raise KeyError("config")
+        return settings
+
+    def get_setting(self, name, default=None):
+        """Return optional setting, works without config.ini."""
+        try:
+            return self.settings.get(name, default)
+        except KeyError:
+            return default
 
-    def find_filename(self):
+    @cached_property
+    def vat_cache(self):
+        """Cache of VAT validation, see vat_backend and vat_ttl settings."""
+        from .vat import BACKENDS, DEFAULT_TTL, VatCache  # noqa: PLC0415
+
+        name = self.get_setting("vat_backend", "vies")
+        if name not in BACKENDS:
+            raise ValueError(f"Unknown VAT validation backend: {name}")
+        return VatCache(
+            self.path(self.config, "vat.json"),
+            BACKENDS[name](),
+            int(self.get_setting("vat_ttl", DEFAULT_TTL)),
+        )
+
+    def get_order_format(self):
+        """Return format of the sequence number and the highest number."""
+        width = self.get_setting(f"{self.series}_order_width")
+        if width:
+            return f"{{:0{int(width)}d}}", 10 ** int(width) - 1
+        return self.order, 999
+
+    def get_data_dir(self, year):
+        """
+        Return directory for new invoices of the year.
+
+        Per year directories are used when the series already stores invoices
+        of this or the previous year there, other series sharing the data
+        directory might use different layout.
+        """
+        for check in (year, year - 1):
+            dirname = self.path(self.data, str(check))
+            if os.path.isdir(dirname) and self.scan(dirname)[0]:
+                return self.path(self.data, str(year))
+        return self.path(self.data)
+
+    def find_last(self, period, order, params):
+        """Return directory for new invoices and last number used in the period."""
+        last = self.sequences.get(period)
+        if last is not None:
+            name = self.template.format(order=order.format(last), **params)
+            for dirname in (
+                self.path(self.data, params["full_year"]),
+                self.path(self.data),
+            ):
+                if os.path.exists(os.path.join(dirname, name)):
+                    return dirname, last
+        # Continue after existing invoices, the last one might have been removed
+        prefix, suffix = self.template.format(order="\0", **params).split("\0")
+        year = int(params["full_year"])
+        last = 0
+        for filename in self.glob(year, int(params["month"])):
+            number = os.path.basename(filename)[len(prefix) : -len(suffix)]
+            if number.isdigit():
+                last = max(last, int(number))
+        return self.get_data_dir(year), last
+
+    def write_invoices(self, invoices, created=None):
+        """
+        Write invoices with contiguous range of numbers, returns filenames.
+
+        The filenames are appended to the created list as the invoices are
+        written, so the caller knows them even if writing fails.
+
+        The last allocated number is stored per period, it is found by
+        scanning existing invoices when its file was removed. Each invoice is
+        written to a temporary file first and linked to its numbered name,
+        the link fails when the number is taken, so invoice files are always
+        complete. This has to be called with lock held.
+        """
         today = datetime.date.today()
-        year = today.strftime("%y")
-        full_year = today.strftime("%Y")
-        month = today.strftime("%m")
-        for i in range(1, 1000):
-            filename = self.path(
-                self.data,
-                self.template.format(
-                    year=year,
-                    month=month,
-                    order=self.order.format(i),
-                    full_year=full_year,
-                ),
-            )
-            if os.path.exists(filename):
-                continue
-            return filename
+        params = {
+            "year": today.strftime("%y"),
+            "month": today.strftime("%m"),
+            "full_year": today.strftime("%Y"),
+        }
+        period = self.template.format(order="*", **params)
+        order, maximum = self.get_order_format()
+        dirname, last = self.find_last(period, order, params)
+        os.makedirs(dirname, exist_ok=True)
+
+        if created is None:
+            created = []
+        temps = []
+        try:
+            for invoice in invoices:
+                handle, temp = mkstemp(suffix=".tmp", prefix=".", dir=dirname)
+                temps.append(temp)
+                with os.fdopen(handle, "w") as output:
+                    invoice.write(output)
+
+            number = last + 1
+            while number + len(temps) - 1 <= maximum:
+                targets = [
+                    os.path.join(
+                        dirname,
+                        self.template.format(order=order.format(number + i), **params),
+                    )
+                    for i in range(len(temps))
+                ]
+                existing = [
+                    i for i, target in enumerate(targets) if os.path.exists(target)
+                ]
+                if existing:
+                    # Start over after the existing file to keep the range contiguous
+                    number += existing[-1] + 1
+                    continue
+                try:
+                    for temp, target in zip(temps, targets, strict=True):
+                        os.link(temp, target)
+                        created.append(target)
+                except FileExistsError:
+                    # Created concurrently without holding the lock
+                    number += len(created) + 1
+                    for target in created:
+                        os.unlink(target)
+                    created.clear()
+                    continue
+                self.sequences.set(period, number + len(temps) - 1)
+                return created
+        finally:
+            for temp in temps:
+                os.unlink(temp)
         raise ValueError("Failed to find invoice number!")
 
-    def create(self, contact, duedelta: int | None = None, **kwargs):
+    def build_invoice(self, contact, duedelta: int | None = None, **kwargs):
         if duedelta is None:
             duedelta = self.default_due
+        today = datetime.date.today()
+        due = today + datetime.timedelta(days=int(duedelta))
+        invoice = RawConfigParser()
+        invoice.add_section("invoice")
+        invoice.set("invoice", "contact", contact)
+        invoice.set("invoice", "date", today.isoformat())
+        invoice.set("invoice", "due", due.isoformat())
+        # Apply defaults from contact
+        contact = self.read_contact(contact)
+        for key, value in contact.items():
+            if not key.startswith("default_"):
+                continue
+            invoice.set("invoice", key[8:], value)
+        # Apply passed value
+        for key, value in kwargs.items():
+            invoice.set("invoice", key, value)
+        # Ensure rate and item are present
+        for key in ("rate", "item"):
+            if not invoice.has_option("invoice", key):
+                invoice.set("invoice", key, "")
+        return invoice
+
+    def create(self, contact, duedelta: int | None = None, **kwargs):
+        (filename,) = self.create_many(
+            [{"contact": contact, "duedelta": duedelta, **kwargs}]
+        )
+        return filename
+
+    def create_many(self, specs, created=None):
+        """
+        Create invoices from list of dicts with create parameters.
+
+        The invoices get contiguous numbers and all are written under a
+        single lock acquisition. Returns list of created filenames, see
+        write_invoices for the created list.
+        """
         with self.lock:
-            today = datetime.date.today()
-            due = today + datetime.timedelta(days=duedelta)
-            filename = self.find_filename()
-            invoice = RawConfigParser()
-            invoice.add_section("invoice")
-            invoice.set("invoice", "contact", contact)
-            invoice.set("invoice", "date", today.isoformat())
-            invoice.set("invoice", "due", due.isoformat())
-            # Apply defaults from contact
-            contact = self.read_contact(contact)
-            for key, value in contact.items():
-                if not key.startswith("default_"):
-                    continue
-                invoice.set("invoice", key[8:], value)
-            # Apply passed value
-            for key, value in kwargs.items():
-                invoice.set("invoice", key, value)
-            # Ensure rate and item are present
-            for key in ("rate", "item"):
-                if not invoice.has_option("invoice", key):
-                    invoice.set("invoice", key, "")
-            # Store the file
-            self.ensure_dir(filename)
-            with open(filename, "w") as handle:
-                invoice.write(handle)
-            return filename
+            invoices = [self.build_invoice(**spec) for spec in specs]
+            if not invoices:
+                return []
+            # Indexed on the next refresh, computing the invoice might need
+            # exchange rates which are not available yet
+            return self.write_invoices(invoices, created)
+
+    def list_contacts(self):
+        """Return sorted keys of all contacts."""
+        directory = self.path(self.contacts)
+        if not os.path.exists(directory):
+            return []
+        with os.scandir(directory) as entries:
+            return sorted(
+                entry.name[:-4] for entry in entries if entry.name.endswith(".ini")
+            )
 
     def contact_path(self, name):
         return self.path(self.contacts, f"{name}.ini")
@@ -169,25 +698,29 @@ class InvoiceStorage:
         data.read(self.contact_path(name))
         return data
 
+    @timed("contact")
     def read_contact(self, name):
-        data = self.parse_contact(name)
-        try:
-            return dict(data["contact"])
-        except KeyError as error:
-            raise ValueError(f"Contact {name} not found!") from error
+        contact = self.read_section("contact", self.contact_path(name))
+        if contact is None:
+            raise ValueError(f"Contact {name} not found!")
+        return contact
 
     def bank_path(self, name):
         return self.path(self.banks, f"{name}.ini")
 
-    def read_bank(self, name, extra_suffix=None):
-        data = RawConfigParser()
-        data.read(self.bank_path(name))
+    def bank_paths(self, name, extra_suffix=None):
+        """Return bank files, the suffixed one overrides the base one."""
+        filenames = [self.bank_path(name)]
         if extra_suffix:
-            data.read(self.path(self.banks, f"{name}-{extra_suffix}.ini"))
-        try:
-            return dict(data["bank"])
-        except KeyError as error:
-            raise ValueError(f"Bank account {name} not found!") from error
+            filenames.append(self.path(self.banks, f"{name}-{extra_suffix}.ini"))
+        return filenames
+
+    @timed("bank")
+    def read_bank(self, name, extra_suffix=None):
+        bank = self.read_section("bank", *self.bank_paths(name, extra_suffix))
+        if bank is None:
+            raise ValueError(f"Bank account {name} not found!")
+        return bank
 
     def update_bank(self, name, **kwargs):
         filename = self.bank_path(name)
@@ -206,6 +739,7 @@ class InvoiceStorage:
 
         with open(filename, "w") as handle:
             bank.write(handle)
+        self.invalidate(filename)
         return filename
 
     def update_contact(  # noqa: PLR0913
@@ -243,6 +777,7 @@ class InvoiceStorage:
 
         with open(filename, "w") as handle:
             contact.write(handle)
+        self.invalidate(filename)
         return filename
 
 
@@ -252,11 +787,13 @@ class QuoteStorage(InvoiceStorage):
     tex = "quotes"
     template = "Q{full_year}{order}.ini"
     default_due = 30
+    series = "quote"
 
     base = Quote
 
 
 class WebStorage(InvoiceStorage):
+    series = "web"
     template = "W{year}{month}{order}.ini"
     order = "{:03d}"
 
@@ -267,5 +804,6 @@ class ProformaStorage(InvoiceStorage):
     tex = "proforma"
     template = "P{full_year}{order}.ini"
     order = "{:05d}"
+    series = "proforma"
 
     base = Proforma
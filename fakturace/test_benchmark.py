@@ -0,0 +1,33 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .benchmark import format_table, generate, run, use_rates
+from .storage import InvoiceStorage, WebStorage
+
+
+class BenchmarkTest(TestCase):
+    def test_generate(self):
+        with TemporaryDirectory() as basedir:
+            filenames = generate(basedir, invoices=60, contacts=5, years=(2024,))
+            assert len(filenames) == 60
+            assert len(set(filenames)) == 60
+            storage = InvoiceStorage(basedir)
+            assert len(storage.glob()) == 36
+            assert len(WebStorage(basedir).glob()) == 24
+            with use_rates(basedir):
+                invoices = list(storage.list(2024))
+                assert len(invoices) == 36
+                assert sum(invoice.paid() for invoice in invoices) == 28
+                assert {invoice.currency for invoice in invoices} == {"CZK", "EUR"}
+                assert invoices[0].amount_czk > 0
+            assert os.path.exists(os.path.join(basedir, "rates", "rates-year-2024"))
+
+    def test_run(self):
+        results = run([20], contacts=3, years=(2024,), count=5, startup=1)
+        operations = [result["operation"] for result in results]
+        assert "summary" in operations
+        assert "write_tex" in operations
+        assert "startup (detail)" in operations
+        assert all(result["seconds"] > 0 for result in results)
+        assert "write_tex" in format_table(results)
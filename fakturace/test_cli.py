@@ -0,0 +1,418 @@
+import datetime
+import json
+import os
+import subprocess
+import sys
+from argparse import Namespace
+from configparser import RawConfigParser
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+from xml.etree import ElementTree
+
+import pytest
+
+from . import timing
+from .cli import SOCKET, XMLExport, execute, main
+from .server import Server
+from .storage import InvoiceStorage
+from .test_vat import FakeBackend
+from .vat import BACKENDS
+
+
+class CommandTest(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.storage = InvoiceStorage(self.tempdir.name)
+        self.storage.update_bank("CZK", bank="Test")
+        self.storage.update_contact(
+            "test",
+            "Name",
+            "Address",
+            "City",
+            "Country",
+            "noreply@example.com",
+            "",
+            "",
+            "CZK",
+            "hosting",
+        )
+        with open(self.storage.path("config", "config.ini"), "w") as handle:
+            handle.write("[config]\ncategories = hosting,support\n")
+        olddir = os.getcwd()
+        os.chdir(self.tempdir.name)
+        self.addCleanup(os.chdir, olddir)
+
+    def create(self, invoiceid, date, **kwargs):
+        filename = self.storage.path("data", f"{invoiceid}.ini")
+        invoice = RawConfigParser()
+        invoice["invoice"] = {"contact": "test", "date": date, "due": date, **kwargs}
+        self.storage.ensure_dir(filename)
+        with open(filename, "w") as handle:
+            invoice.write(handle)
+        return filename
+
+    def run_command(self, *args):
+        output = StringIO()
+        with redirect_stdout(output):
+            main(list(args))
+        return output.getvalue()
+
+    def test_summary(self):
+        self.create("241101", "2024-11-05", rate="100", item="Hosting")
+        self.create(
+            "250101", "2025-01-10", rate="200", item="Hosting", category="support"
+        )
+        output = self.run_command("summary", "--from", "2024-10", "--to", "2025-02")
+        lines = output.splitlines()
+        assert len(lines) == 2 + 5 + 2
+        assert lines[3] == "2024/11     100 CZK     100 CZK       0 CZK"
+        assert lines[5] == "2025/01     200 CZK       0 CZK     200 CZK"
+        assert lines[-1] == "Summary     300 CZK     100 CZK     200 CZK"
+
+        assert (
+            self.run_command(
+                "summary", "--from", "2024-10", "--to", "2025-02", "-j", "2"
+            )
+            == output
+        )
+
+        output = self.run_command("summary", "--years", "2024-2025")
+        lines = output.splitlines()
+        assert len(lines) == 2 + 24 + 2
+        assert lines[-1] == "Summary     300 CZK     100 CZK     200 CZK"
+
+        output = self.run_command("summary", "--year", "2025", "-s")
+        lines = output.splitlines()
+        assert len(lines) == 2 + 12 + 2
+        assert lines[-1] == "Summary     200 CZK       0 CZK     200 CZK"
+
+        # Bucketed by the filename period, regardless of the date
+        self.create("250102", "2024-12-31", rate="50", item="Hosting")
+        output = self.run_command("summary", "--year", "2025")
+        assert "2025/01     250 CZK" in output
+        output = self.run_command("summary", "--year", "2024")
+        assert output.splitlines()[-1].startswith("Summary     100 CZK")
+
+        # Bucketed by date without month in the filename
+        filename = self.storage.path("quotes", "Q2025001.ini")
+        self.storage.ensure_dir(filename)
+        os.rename(
+            self.create("Q2025001", "2024-12-31", rate="10", item="Quote"), filename
+        )
+        output = self.run_command("--quotes", "summary", "--year", "2024")
+        assert "2024/12      10 CZK" in output
+
+    def test_import(self):
+        with open("invoices.csv", "w") as handle:
+            handle.write("contact,item,rate,category\n")
+            handle.write("test,First,100,\n")
+            handle.write("test,Second,200,support\n")
+        output = self.run_command("import", "invoices.csv")
+        invoiceids = output.split()
+        assert len(invoiceids) == 2
+        assert self.storage.get(invoiceids[0]).category == "hosting"
+        assert self.storage.get(invoiceids[1]).category == "support"
+
+        with open("invoices.json", "w") as handle:
+            handle.write(
+                '{"contact": "test", "item": "Third", "rate": 300, "category": null}\n'
+            )
+        output = self.run_command("import", "invoices.json")
+        assert self.storage.get(output.strip()).amount == "300.00"
+        assert self.storage.get(output.strip()).category == "hosting"
+
+        # Invoices written before a failure are reported
+        link = os.link
+        calls = []
+
+        def failing_link(source, target):
+            calls.append(target)
+            if len(calls) > 1:
+                raise OSError("No space left on device")
+            link(source, target)
+
+        output = StringIO()
+        with (
+            redirect_stdout(output),
+            patch("os.link", failing_link),
+            pytest.raises(OSError, match="No space"),
+        ):
+            main(["import", "invoices.csv"])
+        (invoiceid,) = output.getvalue().split()
+        assert self.storage.get(invoiceid).invoice["item"] == "First"
+
+    def legacy_export(self, year):
+        """Export built as a whole document like the original implementation."""
+        args = Namespace(
+            quotes=False,
+            web=False,
+            proforma=False,
+            year=year,
+            filter=None,
+            vat=False,
+            match=None,
+            output=None,
+            since_last=False,
+            jobs=None,
+            series=None,
+            years=None,
+        )
+        command = XMLExport(args)
+        document = ElementTree.Element("MoneyData")
+        invoices = ElementTree.SubElement(document, "SeznamFaktVyd")
+        for invoice in command.list():
+            invoices.append(command.build_invoice(invoice))
+        ElementTree.indent(document)
+        output = StringIO()
+        with redirect_stdout(output):
+            ElementTree.dump(document)
+        return output.getvalue()
+
+    def test_xmlexport(self):
+        output = self.run_command("xmlexport", "--year", "2024")
+        assert output == "<MoneyData>\n  <SeznamFaktVyd />\n</MoneyData>\n"
+        assert output == self.legacy_export(2024)
+
+        self.create("241101", "2024-11-05", rate="100", item="Hosting & <more>")
+        self.create(
+            "241102", "2024-11-06", rate="10", item="Support", item_2="Extra", vat="21"
+        )
+        output = self.run_command("xmlexport", "--year", "2024")
+        assert "<Popis>Hosting &amp; &lt;more&gt;</Popis>" in output
+        assert output == self.legacy_export(2024)
+        assert self.run_command("xmlexport", "--year", "2024", "-j", "2") == output
+
+        self.run_command("xmlexport", "--year", "2024", "--output", "export.xml")
+        with open("export.xml") as handle:
+            assert handle.read() == output
+
+    def test_xmlexport_since_last(self):
+        first = self.create("241101", "2024-11-05", rate="100", item="First")
+        output = self.run_command("xmlexport", "--year", "2024", "--since-last")
+        assert output.count("<FaktVyd>") == 1
+
+        # Nothing changed
+        output = self.run_command("xmlexport", "--year", "2024", "--since-last")
+        assert output == "<MoneyData>\n  <SeznamFaktVyd />\n</MoneyData>\n"
+
+        # New and modified invoices
+        self.create("241102", "2024-11-06", rate="10", item="Second")
+        output = self.run_command("xmlexport", "--year", "2024", "--since-last")
+        assert "<Doklad>241102</Doklad>" in output
+        assert "<Doklad>241101</Doklad>" not in output
+        with open(first, "a") as handle:
+            handle.write("quantity = 2\n")
+        output = self.run_command("xmlexport", "--year", "2024", "--since-last")
+        assert "<Doklad>241101</Doklad>" in output
+        assert "<Doklad>241102</Doklad>" not in output
+
+        # Regular export is not affected
+        output = self.run_command("xmlexport", "--year", "2024")
+        assert output.count("<FaktVyd>") == 2
+
+    def test_timings(self):
+        self.create("241101", "2024-11-05", rate="100", item="Hosting")
+        errors = StringIO()
+        with redirect_stderr(errors):
+            output = self.run_command("--timings-json", "list", "--year", "2024")
+        assert "241101" in output
+        stats = json.loads(errors.getvalue())
+        assert stats["glob"]["calls"] == 1
+        assert stats["index"]["misses"] == 1
+        assert not timing.ENABLED
+
+        errors = StringIO()
+        with redirect_stderr(errors):
+            self.run_command("--timings", "--profile", "list.prof", "list")
+        assert errors.getvalue().startswith("Phase")
+        assert "index" in errors.getvalue()
+        assert os.path.exists("list.prof")
+
+    def test_lazy_imports(self):
+        code = (
+            "import sys, fakturace.cli; "
+            "print(' '.join(name for name in ('jinja2', 'vies', 'django', "
+            "'xml.etree.ElementTree', 'urllib.request', 'concurrent.futures', "
+            "'cProfile') if name in sys.modules))"
+        )
+        result = subprocess.run(
+            [sys.executable, "-c", code],
+            check=True,
+            capture_output=True,
+            text=True,
+            cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        )
+        assert result.stdout.strip() == ""
+
+    def test_serve(self):
+        self.create("241101", "2024-11-05", rate="100", item="Hosting")
+        storages = {InvoiceStorage: InvoiceStorage()}
+        requests = []
+
+        def handle(args):
+            requests.append(args)
+            return execute(args, storages)
+
+        daemon = Server(SOCKET, handle)
+        thread = Thread(target=daemon.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(daemon.server_close)
+        self.addCleanup(daemon.shutdown)
+
+        output = self.run_command("list", "--year", "2024")
+        assert "241101: 100.00 CZK (100.00 CZK): Hosting [Name]" in output
+        assert requests == [["list", "--year", "2024"]]
+
+        # Changed files are picked up by the resident storage
+        self.storage.update_contact(
+            "test", "Other", "", "", "", "", "", "", "CZK", "hosting"
+        )
+        with open(self.storage.path("config", "config.ini"), "w") as handle:
+            handle.write("[config]\ncategories = hosting,support,training\n")
+        output = self.run_command("list", "--year", "2024")
+        assert "[Other]" in output
+        output = self.run_command("summary", "--year", "2024")
+        assert "training" in output.splitlines()[0].lower()
+
+        # Errors are reported with status
+        assert execute(["detail", "missing"], storages)["status"] == 1
+        assert execute(["bogus"], storages)["status"] == 2
+
+        # Local execution
+        self.run_command("--local", "list", "--year", "2024")
+        assert len(requests) == 3
+
+    def test_migrate(self):
+        self.create("241101", "2024-11-05", rate="100", item="First")
+        self.create("250101", "2025-01-10", rate="200", item="Second")
+        self.storage.get("241101").mark_paid("paid")
+        self.run_command("xmlexport", "--year", "2024", "--since-last")
+
+        output = self.run_command("migrate")
+        assert output == "Moved 2 invoices\n"
+        assert os.path.exists("data/2024/241101.ini")
+        assert os.path.exists("data/2024/241101.paid")
+        assert os.path.exists("data/2025/250101.ini")
+        assert self.storage.glob(2024) == [self.storage.path("data/2024/241101.ini")]
+        assert self.storage.get("241101").paid()
+
+        output = self.run_command("list", "--year", "2024")
+        assert "241101" in output
+        assert "250101" not in output
+        output = self.run_command("xmlexport", "--year", "2024", "--since-last")
+        assert output == "<MoneyData>\n  <SeznamFaktVyd />\n</MoneyData>\n"
+
+        # New invoices are stored in the year directory
+        filename = self.storage.create("test")
+        year = str(datetime.date.today().year)
+        assert os.path.dirname(filename) == self.storage.path("data", year)
+
+        output = self.run_command("migrate", "--flat")
+        assert output == "Moved 3 invoices\n"
+        assert not os.path.exists("data/2024")
+        assert os.path.exists("data/241101.paid")
+
+    def test_list_match(self):
+        self.create("241101", "2024-11-05", rate="100", item="Web hosting")
+        self.create("241102", "2024-11-06", rate="200", item="Support")
+        output = self.run_command("list", "--year", "2024", "hosting")
+        assert "241101" in output
+        assert "241102" not in output
+
+        output = self.run_command("list", "--year", "2024", "name supp")
+        assert "241101" not in output
+        assert "241102" in output
+
+        output = self.run_command("xmlexport", "--year", "2024", "hosting")
+        assert output.count("<FaktVyd>") == 1
+
+        output = self.run_command("contacts", "--year", "2024", "nothing")
+        assert output == ""
+
+        # Search without words matches nothing
+        for match in ("#", "...", "-"):
+            output = self.run_command("list", "--year", "2024", match)
+            assert "2411" not in output
+            output = self.run_command("xmlexport", "--year", "2024", match)
+            assert "<FaktVyd>" not in output
+            assert self.run_command("contacts", "--all", match) == ""
+
+    def test_contacts(self):
+        self.storage.update_contact(
+            "other",
+            "Other",
+            "Address",
+            "Town",
+            "DE",
+            "other@example.com",
+            "",
+            "",
+            "CZK",
+            "hosting",
+        )
+        self.create("241101", "2024-11-05", rate="100", item="Hosting")
+        output = self.run_command("contacts", "--year", "2024")
+        assert output == "Name, City, noreply@example.com\n"
+
+        output = self.run_command("contacts", "--all")
+        assert "Name, City" in output
+        assert "Other, Town" in output
+
+        output = self.run_command("contacts", "--all", "--country", "DE")
+        assert output == "Other, Town, other@example.com\n"
+
+        output = self.run_command("contacts", "--all", "oth")
+        assert output == "Other, Town, other@example.com\n"
+
+    def test_validate_contacts(self):
+        BACKENDS["fake"] = FakeBackend
+        self.addCleanup(BACKENDS.pop, "fake")
+        with open(self.storage.path("config", "config.ini"), "a") as handle:
+            handle.write("vat_backend = fake\n")
+        for key, vat_reg in (("valid", "CZ 12345678"), ("invalid", "CZ00000000")):
+            self.storage.update_contact(
+                key,
+                key,
+                "Address",
+                "City",
+                "CZ",
+                "noreply@example.com",
+                "",
+                vat_reg,
+                "CZK",
+                "hosting",
+            )
+
+        output = StringIO()
+        with redirect_stdout(output):
+            assert main(["validate-contacts", "-j", "2"]) == 1
+        output = output.getvalue()
+        assert "valid: CZ12345678: valid\n" in output
+        assert "invalid: CZ00000000: invalid\n" in output
+
+        assert self.run_command("add", "valid").endswith(".ini\n")
+        with pytest.raises(ValueError, match="Invalid VAT"):
+            self.run_command("add", "invalid")
+
+    def test_series(self):
+        self.create("241101", "2024-11-05", rate="100", item="First")
+        self.create("W2501001", "2025-01-10", rate="200", item="Web")
+        output = self.run_command(
+            "--series", "invoice,web", "list", "--years", "2024-2025"
+        )
+        assert "241101: 100.00 CZK" in output
+        assert "W2501001: 200.00 CZK" in output
+        assert "Total: 300.00 CZK" in output
+
+        output = self.run_command(
+            "--series", "invoice,web", "xmlexport", "--years", "2025"
+        )
+        assert output.count("<FaktVyd>") == 1
+
+        with pytest.raises(ValueError, match="single series"):
+            self.run_command("--series", "invoice,web", "detail", "241101")
@@ -0,0 +1,122 @@
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .query import Query
+from .storage import InvoiceStorage
+
+
+class InvoiceIndexTest(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.storage = InvoiceStorage(self.tempdir.name)
+        self.storage.update_bank("CZK", bank="Test")
+        self.storage.update_contact(
+            "test",
+            "Name",
+            "Address",
+            "City",
+            "Country",
+            "noreply@example.com",
+            "",
+            "",
+            "CZK",
+            "test",
+        )
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def count_rows(self):
+        return self.storage.index.connection.execute(
+            "SELECT COUNT(*) FROM invoices"
+        ).fetchone()[0]
+
+    def test_list(self):
+        filename = self.storage.create("test", rate="100", item="Test item")
+        invoice = self.storage.get(filename)
+
+        indexed = list(self.storage.index.list())
+        assert len(indexed) == 1
+        assert indexed[0].invoiceid == invoice.invoiceid
+        assert indexed[0].invoice["item"] == "Test item"
+        assert indexed[0].contact["name"] == "Name"
+        assert indexed[0].category == "test"
+        assert indexed[0].amount == invoice.amount
+        assert indexed[0].amount_czk == invoice.amount_czk
+        assert not indexed[0].paid()
+
+    def test_refresh(self):
+        filename = self.storage.create("test", rate="100", item="Test item")
+        assert len(list(self.storage.index.list())) == 1
+
+        # Modified invoice
+        with open(filename, "a") as handle:
+            handle.write("quantity = 2\n")
+        assert next(self.storage.index.list()).amount == "200.00"
+
+        # Paid marker
+        self.storage.get(filename).mark_paid("paid")
+        assert next(self.storage.index.list()).paid()
+
+        # Removed invoice
+        os.unlink(filename)
+        assert len(list(self.storage.index.list())) == 0
+        assert self.count_rows() == 0
+
+    def test_dependencies(self):
+        self.storage.create("test", rate="100", item="Test item")
+        assert next(self.storage.index.list()).total_amount == "100.00"
+
+        # Bank overrides VAT
+        self.storage.update_bank("CZK", vat="21")
+        assert next(self.storage.index.list()).total_amount == "121.00"
+
+        # Contact provides defaults too
+        (depends,) = self.storage.index.connection.execute(
+            "SELECT depends FROM invoices"
+        ).fetchone()
+        assert os.path.join("contacts", "test.ini") in depends
+
+    def test_search(self):
+        hosting = self.storage.create("test", rate="100", item="Web hosting")
+        support = self.storage.create("test", rate="100", item="Support")
+        with open(support, "a") as handle:
+            handle.write("remark_1 = Hosting migration\n")
+
+        def search(match):
+            return sorted(
+                invoice.name for invoice in self.storage.index.list(match=match)
+            )
+
+        assert search("hosting") == sorted([hosting, support])
+        assert search("host mig") == [support]
+        assert search("WEB") == [hosting]
+        assert search("name") == sorted([hosting, support])
+        assert search("osting") == []
+
+        # Terms are replaced on change
+        with open(hosting) as handle:
+            content = handle.read()
+        with open(hosting, "w") as handle:
+            handle.write(content.replace("Web hosting", "Consulting"))
+        assert search("web") == []
+        assert search("consult") == [hosting]
+
+        os.unlink(support)
+        assert search("migration") == []
+        assert (
+            self.storage.index.connection.execute(
+                "SELECT COUNT(*) FROM terms WHERE filename LIKE '%' || ?",
+                (os.path.basename(support),),
+            ).fetchone()[0]
+            == 0
+        )
+
+    def test_create(self):
+        filename = self.storage.create("test", rate="100", item="Test item")
+        assert next(self.storage.index.list(match="item")).name == filename
+
+        query = Query([self.storage])
+        invoiceid = os.path.splitext(os.path.basename(filename))[0]
+        assert query.contacts() == {"test": [invoiceid]}
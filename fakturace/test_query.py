@@ -0,0 +1,80 @@
+from configparser import RawConfigParser
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+import pytest
+
+from .query import Query, create_storages, parse_series, parse_years
+from .storage import InvoiceStorage, WebStorage
+
+
+class QueryTest(TestCase):
+    def setUp(self):
+        tempdir = TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.storages = create_storages(["invoice", "web"], tempdir.name)
+        storage = self.storages[0]
+        storage.update_bank("CZK", bank="Test")
+        storage.update_contact("test", "Name", "", "", "", "", "", "", "CZK", "test")
+        for storage, invoiceid, date in (
+            (self.storages[0], "230101", "2023-01-05"),
+            (self.storages[0], "240101", "2024-01-05"),
+            (self.storages[0], "250101", "2025-01-05"),
+            (self.storages[1], "W2401001", "2024-01-10"),
+        ):
+            filename = storage.path("data", f"{invoiceid}.ini")
+            invoice = RawConfigParser()
+            invoice["invoice"] = {
+                "contact": "test",
+                "date": date,
+                "due": date,
+                "rate": "100",
+                "item": "Item",
+            }
+            storage.ensure_dir(filename)
+            with open(filename, "w") as handle:
+                invoice.write(handle)
+
+    def test_parse(self):
+        assert parse_years("2024") == [2024]
+        assert parse_years("2019-2021,2025") == [2019, 2020, 2021, 2025]
+        with pytest.raises(ValueError, match="Invalid years"):
+            parse_years("2021-2019")
+        with pytest.raises(ValueError, match="Invalid years"):
+            parse_years("last")
+        assert parse_series("invoice,web") == ["invoice", "web"]
+        with pytest.raises(ValueError, match="Invalid series: bogus"):
+            parse_series("bogus")
+
+    def test_shared_caches(self):
+        invoices, web = self.storages
+        assert isinstance(invoices, InvoiceStorage)
+        assert isinstance(web, WebStorage)
+        assert web.ini_cache is invoices.ini_cache
+        assert web.scan_cache is invoices.scan_cache
+
+    def test_invoices(self):
+        query = Query(self.storages, [2024, 2025])
+        assert [invoice.invoiceid for invoice in query.invoices()] == [
+            "240101",
+            "250101",
+            "W2401001",
+        ]
+        # Only the query years are indexed
+        assert [
+            row["invoiceid"]
+            for row in self.storages[0].database.execute(
+                "SELECT invoiceid FROM invoices ORDER BY invoiceid"
+            )
+        ] == ["240101", "250101", "W2401001"]
+        query = Query(self.storages, [2024])
+        assert [invoice.invoiceid for invoice in query.list(lazy=True)] == [
+            "240101",
+            "W2401001",
+        ]
+        query = Query(self.storages[:1])
+        assert [invoice.invoiceid for invoice in query.list()] == [
+            "230101",
+            "240101",
+            "250101",
+        ]
@@ -0,0 +1,128 @@
+from decimal import Decimal
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import TemporaryDirectory
+from threading import Thread
+from unittest import TestCase
+from unittest.mock import patch
+from urllib.error import HTTPError
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from .rates import DecimalRates, Rates
+
+YEAR_DATA = """Datum|1 EUR|100 JPY
+02.01.2023|24,115|17,321
+03.01.2023|24,140|17,400
+05.01.2023|24,200|17,500
+Datum|1 EUR|1 USD|100 JPY
+06.01.2023|24,250|22,800|17,600
+"""
+
+DAY_DATA = """{}.{}.{} #1
+země|měna|množství|kód|kurz
+EMU|euro|1|EUR|24,600
+Japonsko|jen|100|JPY|15,600
+"""
+
+
+class RatesHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        self.server.requests.append(self.path)
+        if self.server.failures:
+            self.server.failures -= 1
+            self.send_error(503)
+            return
+        if "rok" in query:
+            content = YEAR_DATA
+        else:
+            content = DAY_DATA.format(*query["date"][0].split("."))
+        self.send_response(200)
+        self.end_headers()
+        self.wfile.write(content.encode())
+
+
+class RatesTestCase(TestCase):
+    """Test case with rates served by a local HTTP server."""
+
+    def setUp(self):
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), RatesHandler)
+        self.server.requests = []
+        self.server.failures = 0
+        thread = Thread(target=self.server.serve_forever, daemon=True)
+        thread.start()
+        self.addCleanup(self.server.server_close)
+        self.addCleanup(self.server.shutdown)
+
+        tempdir = TemporaryDirectory()
+        self.addCleanup(tempdir.cleanup)
+        self.cache_dir = tempdir.name
+
+        base = f"http://127.0.0.1:{self.server.server_port}/"
+        for patcher in (
+            patch.object(DecimalRates, "cache_dir", self.cache_dir),
+            patch.object(DecimalRates, "url", base + "day?date={2}.{1}.{0}"),
+            patch.object(DecimalRates, "year_url", base + "year?rok={0}"),
+            patch.dict(DecimalRates.datacache, clear=True),
+            patch.object(DecimalRates, "years", set()),
+            patch.object(DecimalRates, "retry_delay", 0),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+
+class RatesTest(RatesTestCase):
+    def test_download(self):
+        assert Rates.get("2024-01-05", "EUR") == 24.6
+        assert Rates.get("2024-01-05", "CZK") == 1
+        assert DecimalRates.get("2024-01-05", "JPY") == Decimal("15.600")
+        assert len(self.server.requests) == 1
+
+        # Filesystem cache
+        DecimalRates.datacache.clear()
+        DecimalRates.years.clear()
+        assert Rates.get("2024-01-05", "EUR") == 24.6
+        assert len(self.server.requests) == 1
+
+    def test_prefetch(self):
+        # Full year for past years
+        assert DecimalRates.prefetch(2023) == 364
+        assert len(self.server.requests) == 1
+        assert DecimalRates.get("2023-01-02", "EUR") == Decimal("24.115")
+        # Holiday uses the previous rates
+        assert DecimalRates.get("2023-01-04", "EUR") == Decimal("24.140")
+        # Currency list change
+        assert DecimalRates.get("2023-01-06", "USD") == Decimal("22.800")
+        assert DecimalRates.get("2023-12-31", "USD") == Decimal("22.800")
+        assert len(self.server.requests) == 1
+
+        # Loading consolidated cache
+        DecimalRates.datacache.clear()
+        DecimalRates.years.clear()
+        assert DecimalRates.get("2023-01-04", "JPY") == Decimal("17.400")
+        assert "2023-01-05" in DecimalRates.datacache
+        assert len(self.server.requests) == 1
+
+        # Days before first published rates are fetched daily
+        assert DecimalRates.get("2023-01-01", "EUR") == Decimal("24.600")
+        assert len(self.server.requests) == 2
+
+    def test_resolve(self):
+        DecimalRates.resolve(["2024-01-05"])
+        assert len(self.server.requests) == 1
+
+        DecimalRates.resolve(["2024-01-05", "2024-01-08", "2024-01-09", "2024-01-08"])
+        assert len(self.server.requests) == 3
+        assert DecimalRates.get("2024-01-09", "EUR") == Decimal("24.600")
+        assert len(self.server.requests) == 3
+
+    def test_retry(self):
+        self.server.failures = 2
+        assert DecimalRates.get("2024-01-05", "EUR") == Decimal("24.600")
+        assert len(self.server.requests) == 3
+
+        self.server.failures = 3
+        with pytest.raises(HTTPError):
+            DecimalRates.resolve(["2024-01-08"])
+        assert "2024-01-08" not in DecimalRates.datacache
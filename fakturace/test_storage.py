@@ -1,7 +1,51 @@
+import os
+import re
+from configparser import RawConfigParser
 from tempfile import TemporaryDirectory
 from unittest import TestCase
+from unittest.mock import patch
 
-from .storage import InvoiceStorage
+import pytest
+
+from .invoices import render_rows
+from .storage import InvoiceStorage, QuoteStorage, WebStorage, escape_tex
+
+FAKE_XELATEX = """#!/bin/sh
+for arg; do
+    case "$arg" in
+        -output-directory=*) outdir="${arg#-output-directory=}" ;;
+    esac
+done
+name=$(basename "$arg" .tex)
+if grep -q FAIL "$arg"; then
+    echo "Failed" > "$outdir/$name.log"
+    exit 1
+fi
+cp "$arg" "$outdir/$name.pdf"
+echo "Done" > "$outdir/$name.log"
+"""
+
+
+def write_templates(storage):
+    for name, content in (
+        ("invoice.tex", "Invoice \\VAR{invoiceid}\n\\VAR{rows}\n"),
+        ("row.tex", "\\VAR{item|escape_tex} & \\VAR{total}\\\\\n"),
+    ):
+        filename = storage.path("template", name)
+        storage.ensure_dir(filename)
+        with open(filename, "w") as handle:
+            handle.write(content)
+
+
+def fake_xelatex(testdir):
+    """Install fake xelatex and return PATH using it."""
+    bindir = os.path.join(testdir, "bin")
+    os.makedirs(bindir)
+    filename = os.path.join(bindir, "xelatex")
+    with open(filename, "w") as handle:
+        handle.write(FAKE_XELATEX)
+    os.chmod(filename, 0o755)  # noqa: S103
+    return os.pathsep.join((bindir, os.environ["PATH"]))
 
 
 class InvoiceStorageTest(TestCase):
@@ -38,3 +82,416 @@ class InvoiceStorageTest(TestCase):
             # List it
             invoices = list(storage.list())
             assert len(invoices) == 1
+
+    def test_contact_cache(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_bank("EUR", bank="Test")
+            storage.update_contact(
+                "test",
+                "Name",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "EUR",
+                "test",
+            )
+            contact = storage.read_contact("test")
+            # Modifying returned data must not affect the cache
+            contact["name"] = "Other"
+            assert storage.read_contact("test")["name"] == "Name"
+            assert len(storage.ini_cache) == 1
+
+            # Updates are visible
+            storage.update_contact(
+                "test",
+                "Renamed",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "EUR",
+                "test",
+            )
+            assert storage.read_contact("test")["name"] == "Renamed"
+            storage.update_bank("EUR", bank="Other")
+            assert storage.read_bank("EUR")["bank"] == "Other"
+
+            with pytest.raises(ValueError, match="not found"):
+                storage.read_contact("missing")
+
+    def test_build_pdfs(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_bank("CZK", bank="Test")
+            storage.update_contact(
+                "test",
+                "Name",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "CZK",
+                "test",
+            )
+            write_templates(storage)
+            good = storage.create("test", rate="100", item="Test item")
+            bad = storage.create("test", rate="100", item="FAIL")
+            good_id = os.path.splitext(os.path.basename(good))[0]
+            bad_id = os.path.splitext(os.path.basename(bad))[0]
+
+            with patch.dict(os.environ, {"PATH": fake_xelatex(testdir)}):
+                results = {
+                    invoiceid: error
+                    for invoiceid, _built, error in storage.build_pdfs(
+                        [good_id, bad_id], jobs=2
+                    )
+                }
+
+            assert results[good_id] is None
+            assert isinstance(results[bad_id], ValueError)
+            assert os.path.exists(storage.path("pdf", f"{good_id}.pdf"))
+            assert not os.path.exists(storage.path("pdf", f"{bad_id}.pdf"))
+            assert os.path.exists(storage.path("pdf", f"{bad_id}.log"))
+            # Scratch directories are removed
+            assert sorted(os.listdir(storage.path("pdf"))) == [
+                f"{good_id}.pdf",
+                f"{bad_id}.log",
+            ]
+
+    def test_incremental_build(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_bank("CZK", bank="Test")
+            storage.update_contact(
+                "test",
+                "Name",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "CZK",
+                "test",
+            )
+            write_templates(storage)
+            hosting = storage.get(
+                storage.create("test", rate="100", item="Hosting", category="hosting")
+            )
+            support = storage.get(
+                storage.create("test", rate="100", item="Support", category="support")
+            )
+            assert hosting.write_tex()
+            assert support.write_tex()
+            assert not hosting.write_tex()
+            assert not support.write_tex()
+
+            # Category template affects only matching invoices
+            with open(storage.path("template", "invoice-hosting.tex"), "w") as handle:
+                handle.write("Hosting \\VAR{invoiceid}\n")
+            assert hosting.write_tex()
+            assert not support.write_tex()
+
+            # Base template affects all invoices
+            with open(storage.path("template", "invoice.tex"), "a") as handle:
+                handle.write("Changed\n")
+            assert hosting.write_tex()
+            assert support.write_tex()
+            assert support.write_tex(force=True)
+
+            # PDFs are built only once
+            invoiceids = [hosting.invoiceid, support.invoiceid]
+            with patch.dict(os.environ, {"PATH": fake_xelatex(testdir)}):
+                results = list(storage.build_pdfs(invoiceids, jobs=2))
+                assert all(built for _invoiceid, built, _error in results)
+                results = list(storage.build_pdfs(invoiceids, jobs=2))
+                assert not any(built for _invoiceid, built, _error in results)
+
+    def test_lazy_invoice(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_contact(
+                "test",
+                "Name",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "CZK",
+                "test",
+            )
+            filename = storage.create("test", rate="100", item="Test item")
+
+            # Header is available without bank
+            invoice = storage.get(filename, lazy=True)
+            assert invoice.invoice["item"] == "Test item"
+            assert invoice.contact["name"] == "Name"
+            with pytest.raises(ValueError, match="Bank account CZK not found"):
+                invoice.invoice["total"]
+
+            # Details are computed on first access
+            storage.update_bank("CZK", bank="Test", vat="21")
+            invoice = storage.get(filename, lazy=True)
+            assert "total" not in dict(invoice.invoice.header_items())
+            assert invoice.invoice["total_sum"] == "121.00"
+            assert invoice.invoice == storage.get(filename).invoice
+
+            # Dictionary access computes the details as well
+            invoice = storage.get(filename, lazy=True)
+            assert invoice.invoice.get("total_sum") == "121.00"
+            invoice = storage.get(filename, lazy=True)
+            assert "vat" in invoice.invoice
+            invoice = storage.get(filename, lazy=True)
+            assert invoice.invoice == storage.get(filename).invoice
+            invoice = storage.get(filename, lazy=True)
+            assert dict(invoice.invoice.items()) == storage.get(filename).invoice
+            assert invoice.bank == storage.get(filename).bank
+
+    def test_paid_index(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_bank("CZK", bank="Test")
+            storage.update_contact(
+                "test", "Name", "", "", "", "", "", "", "CZK", "test"
+            )
+            first, second = storage.create_many(
+                [{"contact": "test", "rate": "100"}, {"contact": "test", "rate": "200"}]
+            )
+            assert storage.paid_index() == frozenset()
+            invoice = storage.get(first)
+            invoice.mark_paid("paid")
+            assert invoice.paid()
+            assert storage.paid_index() == {invoice.invoiceid}
+
+            # Listing does not check the markers one by one
+            with patch("os.path.exists") as exists:
+                paid = [invoice.paid() for invoice in storage.list()]
+                exists.assert_not_called()
+            assert paid == [True, False]
+            assert [row.paid() for row in storage.index.list()] == [True, False]
+
+            # Directory scan is cached until the directory changes
+            dirname = storage.path("data")
+            stamp = storage.file_stamp(dirname)
+            storage.scan_cache[storage.template, dirname] = (
+                stamp,
+                ({}, frozenset({"cached"}), []),
+            )
+            assert storage.paid_index() == {"cached"}
+            os.unlink(second)
+            assert storage.paid_index() == {invoice.invoiceid}
+
+    def test_parallel_list(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_bank("CZK", bank="Test", vat="21")
+            storage.update_contact(
+                "test", "Name", "", "", "", "", "", "", "CZK", "test"
+            )
+            storage.create_many(
+                [
+                    {"contact": "test", "rate": str(100 + number), "item": "Item"}
+                    for number in range(10)
+                ]
+            )
+            storage.get(storage.glob()[3]).mark_paid("paid")
+            expected = list(storage.list())
+            invoices = list(storage.list(jobs=3))
+            assert [invoice.name for invoice in invoices] == [
+                invoice.name for invoice in expected
+            ]
+            assert [invoice.invoice for invoice in invoices] == [
+                invoice.invoice for invoice in expected
+            ]
+            assert [invoice.paid() for invoice in invoices] == [
+                invoice.paid() for invoice in expected
+            ]
+            assert invoices[0].storage is storage
+
+            # More chunks than the loaded ones kept in flight
+            storage.load_chunk_size = 1
+            invoices = list(storage.list(jobs=2))
+            assert [invoice.name for invoice in invoices] == [
+                invoice.name for invoice in expected
+            ]
+            assert invoices[0].bank == expected[0].bank
+
+            rows = list(storage.index.list(jobs=3))
+            assert [row.amount for row in rows] == [
+                invoice.amount for invoice in expected
+            ]
+            assert [row.paid() for row in rows].count(True) == 1
+
+    def test_write_invoices(self):
+        with TemporaryDirectory() as testdir:
+            storage = WebStorage(testdir)
+            invoice = RawConfigParser()
+            invoice["invoice"] = {"item": "Test"}
+            with storage.lock:
+                (first,) = storage.write_invoices([invoice])
+                assert os.path.basename(first).endswith("001.ini")
+                with open(first) as handle:
+                    assert "item = Test" in handle.read()
+                # Existing files are skipped
+                skipped = first.replace("001.ini", "002.ini")
+                with open(skipped, "w") as handle:
+                    handle.write("")
+                assert storage.write_invoices([invoice])[0].endswith("003.ini")
+
+                # Continues after existing files without stored sequence
+                storage.database.execute("DELETE FROM sequences")
+                assert storage.write_invoices([invoice])[0].endswith("004.ini")
+
+                # Configured width
+                with open(storage.path("config", "config.ini"), "w") as handle:
+                    handle.write("[config]\nweb_order_width = 1\n")
+                assert len(storage.write_invoices([invoice] * 5)) == 5
+                with pytest.raises(ValueError, match="Failed to find"):
+                    storage.write_invoices([invoice])
+                # No temporary files are left behind
+                names = os.listdir(os.path.dirname(first))
+                assert not [name for name in names if name.endswith(".tmp")]
+
+    def test_shared_data_layout(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            web = WebStorage(testdir)
+            invoice = RawConfigParser()
+            invoice["invoice"] = {"item": "Test"}
+            with storage.lock:
+                storage.write_invoices([invoice])
+            storage.migrate()
+            assert storage.partitioned
+            assert not web.partitioned
+
+            # Web invoices stay in the shared data directory
+            with web.lock:
+                (filename,) = web.write_invoices([invoice])
+            assert os.path.dirname(filename) == web.path("data")
+
+            # Ordered by name regardless of the directory
+            later = web.path("data", "2099", "W9901001.ini")
+            os.makedirs(os.path.dirname(later))
+            with open(later, "w") as handle:
+                handle.write("")
+            earlier = web.path("data", "W0001001.ini")
+            with open(earlier, "w") as handle:
+                handle.write("")
+            assert web.glob() == [earlier, filename, later]
+
+    def test_create_many(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            storage.update_contact(
+                "test",
+                "Name",
+                "Address",
+                "City",
+                "Country",
+                "noreply@example.com",
+                "",
+                "",
+                "CZK",
+                "test",
+            )
+            first = storage.create("test", item="First")
+            # Existing file in the way of the contiguous range
+            blocker = first.replace("01.ini", "03.ini")
+            with open(blocker, "w") as handle:
+                handle.write("")
+
+            filenames = storage.create_many(
+                [
+                    {"contact": "test", "item": "Second"},
+                    {"contact": "test", "item": "Third", "duedelta": "30"},
+                ]
+            )
+            assert [os.path.basename(name)[-6:] for name in filenames] == [
+                "04.ini",
+                "05.ini",
+            ]
+            assert not os.path.exists(first.replace("01.ini", "02.ini"))
+            invoice = storage.get(filenames[1], lazy=True)
+            assert invoice.invoice["item"] == "Third"
+            assert invoice.invoice["category"] == "test"
+
+            # Number of removed last invoice is used again
+            os.unlink(filenames[1])
+            assert storage.create("test", item="Fourth") == filenames[1]
+
+            # Nothing is created when writing fails
+            class Broken:
+                def __str__(self):
+                    raise ValueError("broken")
+
+            count = len(storage.glob())
+            with pytest.raises(ValueError, match="broken"):
+                storage.create_many(
+                    [
+                        {"contact": "test", "item": "Fifth"},
+                        {"contact": "test", "item": Broken()},
+                    ]
+                )
+            assert len(storage.glob()) == count
+
+            with pytest.raises(ValueError, match="not found"):
+                storage.create_many([{"contact": "missing"}])
+
+    def test_jinja_environment(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            assert storage.jinja is QuoteStorage(testdir).jinja
+            assert storage.jinja is not InvoiceStorage(os.path.join(testdir, "x")).jinja
+
+            write_templates(storage)
+            template = storage.jinja.get_template("template/row.tex")
+            assert template.render(item="a_b", total="1") == "a\\_b & 1\\\\"
+            # Compiled template is stored in the bytecode cache
+            assert os.listdir(storage.path("config", "jinja-cache"))
+
+
+LEGACY_LATEX_SUBS = (
+    (re.compile(r"\\"), r"\\textbackslash"),
+    (re.compile(r"([{}_#%&$])"), r"\\\1"),
+    (re.compile(r"~"), r"\~{}"),
+    (re.compile(r"\^"), r"\^{}"),
+    (re.compile(r'"'), r"''"),
+    (re.compile(r"\.\.\.+"), r"\\ldots"),
+)
+
+
+class EscapeTest(TestCase):
+    def test_escape_tex(self):
+        for value in (
+            "",
+            "Plain text",
+            r"C:\path\to {file}_name #1 100% & $5",
+            'Quote "this" ~ home ^ power',
+            "Wait... more.... end.. x.",
+            r"\\{}~^...\"",
+        ):
+            expected = value
+            for pattern, replacement in LEGACY_LATEX_SUBS:
+                expected = pattern.sub(replacement, expected)
+            assert escape_tex(value) == expected
+
+    def test_render_rows(self):
+        with TemporaryDirectory() as testdir:
+            storage = InvoiceStorage(testdir)
+            write_templates(storage)
+            template = storage.jinja.get_template("template/row.tex")
+            rows = [{"item": f"Item_{i}", "total": str(i)} for i in range(5)]
+            assert render_rows(template, rows) == "\n".join(
+                template.render(row) for row in rows
+            )
+            assert not render_rows(template, [])
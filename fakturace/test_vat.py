@@ -0,0 +1,70 @@
+import json
+import os
+from tempfile import TemporaryDirectory
+from unittest import TestCase
+
+from .vat import VatCache
+
+
+class FakeBackend:
+    """Validation backend with fixed results."""
+
+    def __init__(self, valid=("CZ12345678",)):
+        self.valid = set(valid)
+        self.checked = []
+
+    def validate(self, vat_reg):
+        self.checked.append(vat_reg)
+        if vat_reg.startswith("XX"):
+            raise ValueError("Service unavailable")
+        return vat_reg in self.valid
+
+
+class VatCacheTest(TestCase):
+    def setUp(self):
+        self.tempdir = TemporaryDirectory()
+        self.addCleanup(self.tempdir.cleanup)
+        self.filename = os.path.join(self.tempdir.name, "vat.json")
+        self.backend = FakeBackend()
+
+    def test_validate(self):
+        cache = VatCache(self.filename, self.backend)
+        assert cache.validate("CZ 1234 5678")
+        assert cache.validate("CZ12345678")
+        assert not cache.validate("CZ00000000")
+        # Invalid results are checked again
+        assert not cache.validate("CZ00000000")
+        assert self.backend.checked == ["CZ12345678", "CZ00000000", "CZ00000000"]
+
+        # Persisted
+        cache = VatCache(self.filename, self.backend)
+        assert cache.validate("CZ12345678")
+        assert len(self.backend.checked) == 3
+
+    def test_expired(self):
+        cache = VatCache(self.filename, self.backend, ttl=1)
+        assert cache.validate("CZ12345678")
+        with open(self.filename) as handle:
+            results = json.load(handle)
+        results["CZ12345678"]["checked"] -= 2 * 86400
+        with open(self.filename, "w") as handle:
+            json.dump(results, handle)
+
+        cache = VatCache(self.filename, self.backend, ttl=1)
+        assert cache.validate("CZ12345678")
+        assert len(self.backend.checked) == 2
+
+    def test_validate_many(self):
+        cache = VatCache(self.filename, self.backend)
+        cache.validate("CZ12345678")
+        results = cache.validate_many(["CZ12345678", "CZ00000000", "XX1"], jobs=2)
+        assert results["CZ12345678"] is True
+        assert results["CZ00000000"] is False
+        assert isinstance(results["XX1"], ValueError)
+        # Valid result is cached
+        assert sorted(self.backend.checked) == ["CZ00000000", "CZ12345678", "XX1"]
+        # Failures are not cached
+        assert "XX1" not in cache.results
+
+        cache.validate_many(["CZ12345678"], refresh=True)
+        assert self.backend.checked.count("CZ12345678") == 2
@@ -0,0 +1,125 @@
+"""
+Instrumentation of the storage phases.
+
+The phases are recorded only when enabled (see --timings), otherwise the
+instrumentation is just a flag check. Phases nest, so the time is cumulative
+including the nested phases. Work done in worker processes (parallel PDF
+builds) is not recorded.
+"""
+
+from __future__ import annotations
+
+import json
+from contextlib import contextmanager
+from functools import wraps
+from time import perf_counter
+
+ENABLED = False
+
+STATS = {}
+
+
+class Phase:
+    """Statistics of a single phase."""
+
+    __slots__ = ("calls", "hits", "misses", "time")
+
+    def __init__(self):
+        self.calls = 0
+        self.time = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def as_dict(self):
+        result = {"calls": self.calls, "time": self.time}
+        if self.hits or self.misses:
+            result["hits"] = self.hits
+            result["misses"] = self.misses
+            result["hit_rate"] = self.hits / (self.hits + self.misses)
+        return result
+
+
+def get_phase(name):
+    if name not in STATS:
+        STATS[name] = Phase()
+    return STATS[name]
+
+
+def enable():
+    """Enable recording and clear statistics."""
+    global ENABLED  # noqa: PLW0603
+    ENABLED = True
+    STATS.clear()
+
+
+def disable():
+    global ENABLED  # noqa: PLW0603
+    ENABLED = False
+
+
+@contextmanager
+def phase(name):
+    """Record time spent in the block."""
+    if not ENABLED:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        stats = get_phase(name)
+        stats.calls += 1
+        stats.time += perf_counter() - start
+
+
+def timed(name):
+    """Record time spent in the decorated function."""
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            if not ENABLED:
+                return function(*args, **kwargs)
+            with phase(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def cache(name, *, hit):
+    """Record cache hit or miss for a phase."""
+    if not ENABLED:
+        return
+    stats = get_phase(name)
+    if hit:
+        stats.hits += 1
+    else:
+        stats.misses += 1
+
+
+def report():
+    """Return recorded statistics ordered by time."""
+    return {
+        name: stats.as_dict()
+        for name, stats in sorted(
+            STATS.items(), key=lambda item: item[1].time, reverse=True
+        )
+    }
+
+
+def format_json():
+    return json.dumps(report(), indent=2)
+
+
+def format_table():
+    header = "{:<14} {:>8} {:>10} {:>10}".format(
+        "Phase", "Calls", "Time [s]", "Hit rate"
+    )
+    lines = [header, "-" * len(header)]
+    for name, stats in report().items():
+        hit_rate = "{:.1%}".format(stats["hit_rate"]) if "hit_rate" in stats else ""
+        line = f"{name:<14} {stats['calls']:>8} {stats['time']:>10.3f} {hit_rate:>10}"
+        lines.append(line.rstrip())
+    return "\n".join(lines)
@@ -0,0 +1,124 @@
+"""
+Validation of VAT numbers with a persistent cache.
+
+The results are stored in a JSON file in the config directory keyed by the
+VAT number. Only valid results are trusted until they expire, invalid ones
+are checked again, so that a fixed registration is picked up right away.
+"""
+
+from __future__ import annotations
+
+import json
+import os
+import time
+
+from .timing import cache, timed
+
+# Default time to trust validation result, in days
+DEFAULT_TTL = 30
+
+
+def normalize(vat_reg):
+    """Return VAT number without whitespace."""
+    return vat_reg.strip().replace(" ", "").upper()
+
+
+class ViesBackend:
+    """Validation using the EU VIES service."""
+
+    def validate(self, vat_reg):
+        from vies.types import VATIN  # noqa: PLC0415
+
+        return bool(VATIN(vat_reg[:2], vat_reg[2:]).data.valid)
+
+
+# Validation backends selectable by the vat_backend setting
+BACKENDS = {"vies": ViesBackend}
+
+
+class VatCache:
+    """Cache of VAT validation results stored in a JSON file."""
+
+    def __init__(self, filename, backend, ttl=DEFAULT_TTL):
+        self.filename = filename
+        self.backend = backend
+        self.ttl = ttl * 86400
+        self._results = None
+
+    @property
+    def results(self):
+        if self._results is None:
+            if os.path.exists(self.filename):
+                with open(self.filename) as handle:
+                    self._results = json.load(handle)
+            else:
+                self._results = {}
+        return self._results
+
+    def save(self):
+        temp = f"{self.filename}.tmp"
+        with open(temp, "w") as handle:
+            json.dump(self.results, handle, indent=2, sort_keys=True)
+        os.replace(temp, self.filename)
+
+    def get(self, vat_reg):
+        """Return cached valid result, None if it has to be checked."""
+        result = self.results.get(vat_reg)
+        if result is None or not result["valid"]:
+            return None
+        if time.time() - result["checked"] > self.ttl:
+            return None
+        return result["valid"]
+
+    def store(self, vat_reg, valid):
+        self.results[vat_reg] = {"valid": valid, "checked": time.time()}
+
+    @timed("vat")
+    def validate(self, vat_reg):
+        """Check whether the VAT number is valid, using cached result if fresh."""
+        vat_reg = normalize(vat_reg)
+        valid = self.get(vat_reg)
+        cache("vat", hit=valid is not None)
+        if valid is None:
+            valid = self.backend.validate(vat_reg)
+            self.store(vat_reg, valid)
+            self.save()
+        return valid
+
+    @timed("vat")
+    def validate_many(self, numbers, jobs=4, *, refresh=False):
+        """
+        Check several VAT numbers, at most jobs of them concurrently.
+
+        Returns dict of VAT numbers and results, the result is the exception
+        for failed checks, these are not cached.
+        """
+        numbers = {normalize(vat_reg) for vat_reg in numbers}
+        result = {}
+        pending = []
+        for vat_reg in sorted(numbers):
+            valid = None if refresh else self.get(vat_reg)
+            cache("vat", hit=valid is not None)
+            if valid is None:
+                pending.append(vat_reg)
+            else:
+                result[vat_reg] = valid
+
+        def check(vat_reg):
+            try:
+                return self.backend.validate(vat_reg)
+            except Exception as error:  # noqa: BLE001
+                return error
+
+        if pending:
+            from concurrent.futures import ThreadPoolExecutor  # noqa: PLC0415
+
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                for vat_reg, valid in zip(
+                    pending, executor.map(check, pending), strict=True
+                ):
+                    result[vat_reg] = valid
+                    if isinstance(valid, bool):
+                        self.store(vat_reg, valid)
+            self.save()
+        return result